@@ -1,70 +1,328 @@
 import os
+from hashlib import sha256
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from multiprocessing.shared_memory import SharedMemory
 
 # Import FEAL functions (assumed to be defined earlier)
-from feal_4 import encrypt as feal_encrypt, decrypt as feal_decrypt, key_generation
+from feal_4 import get_cipher
+import feal_numpy
+import instrument
 
-def cfb_encrypt(key, iv, plaintext, segment_size):
+MASK64 = (1 << 64) - 1
+
+# Chunk size used by the file helpers
+BUFFER_SIZE = 64 * 1024
+
+# Ciphertexts shorter than this are decrypted in-process by cfb_decrypt_parallel
+PARALLEL_THRESHOLD = 256 * 1024
+
+def check_segment_size(segment_size):
     # Ensure segment size is a multiple of 8 bits
     if segment_size % 8 != 0:
         raise ValueError("Segment size must be a multiple of 8 bits")
-    
+
     segment_size_bytes = segment_size // 8
 
     # Ensure segment size is valid
     if segment_size_bytes < 1 or segment_size_bytes > 8:  # FEAL block size is 8 bytes
         raise ValueError("Invalid segment size")
 
-    ciphertext = b''
-    current_iv = iv
+    return segment_size_bytes
+
+def output_buffer(length, out):
+    # Allocate the output once, or check the caller's buffer is large enough
+    if out is None:
+        return bytearray(length)
+    if len(out) < length:
+        raise ValueError("Output buffer is too small")
+    return out
 
-    # Generate subkeys for FEAL
-    subkey = key_generation(key)
+def crypt_segments(encrypt_word, register, src, dst, segment_size_bytes, decrypting):
+    # Run CFB over the whole segments of src into dst and return the new
+    # shift register. len(src) must be a multiple of segment_size_bytes.
+    bits = segment_size_bytes * 8
+    shift = 64 - bits
 
-    # Process each plaintext segment
-    for i in range(0, len(plaintext), segment_size_bytes):
-        segment = plaintext[i:i + segment_size_bytes]
-        
-        # Compute O(j) = CIPH(I(j))
-        o = feal_encrypt(current_iv, subkey)
-        
-        # Compute C(j) = P(j) XOR MSB(O(j))
-        c_segment = bytes([segment[j] ^ o[j] for j in range(len(segment))])
-        ciphertext += c_segment
+    for i in range(0, len(src), segment_size_bytes):
+        # Compute O(j) = CIPH(I(j)), keeping MSB(O(j))
+        o = encrypt_word(register) >> shift
+        segment = int.from_bytes(src[i:i + segment_size_bytes], 'big')
+        result = segment ^ o
+        dst[i:i + segment_size_bytes] = result.to_bytes(segment_size_bytes, 'big')
 
         # Compute I(j+1) = LSB(I(j)) | C(j)
-        current_iv = current_iv[segment_size_bytes:] + c_segment
+        register = ((register << bits) | (segment if decrypting else result)) & MASK64
 
-    return ciphertext
+    return register
 
-def cfb_decrypt(key, iv, ciphertext, segment_size):
-    # Ensure segment size is a multiple of 8 bits
-    if segment_size % 8 != 0:
-        raise ValueError("Segment size must be a multiple of 8 bits")
-    
-    segment_size_bytes = segment_size // 8
+def crypt_tail(encrypt_word, register, src, dst):
+    # Last, shorter segment: only its leading bytes of O(j) are used
+    tail = len(src)
+    o = encrypt_word(register) >> (64 - tail * 8)
+    dst[:tail] = (int.from_bytes(src, 'big') ^ o).to_bytes(tail, 'big')
 
-    # Ensure segment size is valid
-    if segment_size_bytes < 1 or segment_size_bytes > 8:  # FEAL block size is 8 bytes
-        raise ValueError("Invalid segment size")
+def cfb_crypt(key, iv, data, segment_size, out, decrypting):
+    segment_size_bytes = check_segment_size(segment_size)
+    buffer = output_buffer(len(data), out)
 
-    plaintext = b''
-    current_iv = iv
+    # Views over the input and output, so segments are never copied out
+    src = memoryview(data).cast('B')
+    dst = memoryview(buffer).cast('B')
 
-    # Generate subkeys for FEAL
-    subkey = key_generation(key)
+    cipher = get_cipher(key)
+    n = len(src)
+    if instrument.enabled:
+        segments = -(-n // segment_size_bytes)
+        instrument.count('cfb.segments', segments)
+        instrument.count('feal.blocks', segments)
+    if decrypting and feal_numpy.AVAILABLE and n >= feal_numpy.NUMPY_THRESHOLD * segment_size_bytes:
+        # Every register is known from the ciphertext, so decrypt all at once
+        feal_numpy.cfb_decrypt_into(cipher.subkey, bytes(iv), src, dst[:n], segment_size_bytes)
+        return buffer
 
-    # Process each ciphertext segment
-    for i in range(0, len(ciphertext), segment_size_bytes):
-        segment = ciphertext[i:i + segment_size_bytes]
-        
-        # Compute O(j) = CIPH(I(j))
-        o = feal_encrypt(current_iv, subkey)
-        
-        # Compute P(j) = C(j) XOR MSB(O(j))
-        p_segment = bytes([segment[j] ^ o[j] for j in range(len(segment))])
-        plaintext += p_segment
+    # The shift register I(j) and each O(j) are held as 64-bit ints
+    encrypt_word = cipher.encrypt_word
+    register = int.from_bytes(iv, 'big')
+    full = n - n % segment_size_bytes
 
-        # Compute I(j+1) = LSB(I(j)) | C(j)
-        current_iv = current_iv[segment_size_bytes:] + segment
+    register = crypt_segments(encrypt_word, register, src[:full], dst[:full], segment_size_bytes, decrypting)
+    if full < n:
+        crypt_tail(encrypt_word, register, src[full:], dst[full:n])
+
+    return buffer
+
+@instrument.timed('cfb_encrypt')
+def cfb_encrypt(key, iv, plaintext, segment_size, out=None):
+    # Compute C(j) = P(j) XOR MSB(O(j)) for each plaintext segment.
+    # Returns the ciphertext in a new bytearray, the only allocation, or
+    # with out, in that buffer (which may be the plaintext buffer itself).
+    return cfb_crypt(key, iv, plaintext, segment_size, out, False)
+
+@instrument.timed('cfb_decrypt')
+def cfb_decrypt(key, iv, ciphertext, segment_size, out=None):
+    # Compute P(j) = C(j) XOR MSB(O(j)) for each ciphertext segment.
+    # Returns the plaintext in a new bytearray, the only allocation, or
+    # with out, in that buffer (which may be the ciphertext buffer itself).
+    return cfb_crypt(key, iv, ciphertext, segment_size, out, True)
+
+class CfbEncryptor:
+    # Incremental CFB encryption. update() may be called with chunks of any
+    # length; bytes of an unfinished segment are held until the next call,
+    # and finalize() encrypts the last, possibly shorter, segment. The
+    # concatenated output equals cfb_encrypt over the concatenated input.
+    decrypting = False
+
+    def __init__(self, key, iv, segment_size):
+        self.segment_size_bytes = check_segment_size(segment_size)
+        self.encrypt_word = get_cipher(key).encrypt_word
+        self.register = int.from_bytes(iv, 'big')
+        self.pending = b''
+        self.finalized = False
+
+    def update_into(self, chunk, out):
+        # Process chunk, writing the finished segments into out (which needs
+        # room for len(chunk) + segment_size_bytes - 1 bytes). Returns the
+        # number of bytes written.
+        if self.finalized:
+            raise ValueError("update() called after finalize()")
+
+        src = memoryview(chunk).cast('B')
+        dst = memoryview(out).cast('B')
+        size = self.segment_size_bytes
+        written = 0
+
+        if self.pending:
+            # Complete the segment left over from the previous chunk
+            need = size - len(self.pending)
+            if len(src) < need:
+                self.pending += bytes(src)
+                return 0
+            segment = self.pending + bytes(src[:need])
+            src = src[need:]
+            self.register = crypt_segments(self.encrypt_word, self.register, segment, dst[:size], size, self.decrypting)
+            self.pending = b''
+            written = size
+
+        full = len(src) - len(src) % size
+        if instrument.enabled:
+            segments = full // size + (written // size)
+            instrument.count('cfb.segments', segments)
+            instrument.count('feal.blocks', segments)
+        self.register = crypt_segments(self.encrypt_word, self.register, src[:full], dst[written:written + full], size, self.decrypting)
+        self.pending = bytes(src[full:])
+        return written + full
+
+    def update(self, chunk):
+        # Process chunk and return the bytes of the segments it completes
+        out = bytearray(len(self.pending) + len(chunk))
+        return bytes(out[:self.update_into(chunk, out)])
+
+    def finalize(self):
+        # Process the remaining partial segment, if any
+        if self.finalized:
+            raise ValueError("finalize() called twice")
+        self.finalized = True
+        out = bytearray(len(self.pending))
+        if self.pending:
+            if instrument.enabled:
+                instrument.count('cfb.segments')
+                instrument.count('feal.blocks')
+            crypt_tail(self.encrypt_word, self.register, self.pending, out)
+        self.pending = b''
+        return bytes(out)
+
+class CfbDecryptor(CfbEncryptor):
+    # Incremental CFB decryption, the counterpart of CfbEncryptor.
+    decrypting = True
+
+def crypt_file(stream, source, destination, buffer_size):
+    # Stream source into destination through fixed-size buffers. Both may be
+    # paths or binary file objects (a socket's makefile() works too).
+    with ExitStack() as stack:
+        if isinstance(source, (str, os.PathLike)):
+            source = stack.enter_context(open(source, 'rb'))
+        if isinstance(destination, (str, os.PathLike)):
+            destination = stack.enter_context(open(destination, 'wb'))
+
+        buffer = bytearray(buffer_size)
+        out = bytearray(buffer_size + stream.segment_size_bytes)
+        view, out_view = memoryview(buffer), memoryview(out)
+        total = 0
+
+        while True:
+            n = source.readinto(buffer)
+            if not n:
+                break
+            written = stream.update_into(view[:n], out_view)
+            destination.write(out_view[:written])
+            total += written
+
+        tail = stream.finalize()
+        destination.write(tail)
+        return total + len(tail)
+
+def cfb_encrypt_file(key, iv, source, destination, segment_size, buffer_size=BUFFER_SIZE):
+    # Encrypt source into destination with constant memory, returning the
+    # number of bytes written.
+    return crypt_file(CfbEncryptor(key, iv, segment_size), source, destination, buffer_size)
+
+def cfb_decrypt_file(key, iv, source, destination, segment_size, buffer_size=BUFFER_SIZE):
+    # Decrypt source into destination with constant memory, returning the
+    # number of bytes written.
+    return crypt_file(CfbDecryptor(key, iv, segment_size), source, destination, buffer_size)
+
+def register_at(iv, ciphertext, offset):
+    # Shift register I(j) for the segment starting at byte offset: the last
+    # 8 bytes of IV || C(0) || ... || C(j-1), so it needs only the ciphertext.
+    if offset >= 8:
+        return int.from_bytes(ciphertext[offset - 8:offset], 'big')
+    return int.from_bytes(bytes(iv[offset:]) + bytes(ciphertext[:offset]), 'big')
+
+def decrypt_range(key, iv, segment_size_bytes, src_name, dst_name, length, start, end):
+    # Worker: decrypt ciphertext[start:end] from shared memory src_name into
+    # the same range of dst_name. start is on a segment boundary.
+    src_shm = SharedMemory(name=src_name)
+    dst_shm = SharedMemory(name=dst_name)
+    try:
+        src = src_shm.buf[:length]
+        dst = dst_shm.buf[:length]
+        cipher = get_cipher(key)
+        register = register_at(iv, src, start)
+        full = start + (end - start) - (end - start) % segment_size_bytes
+
+        if feal_numpy.AVAILABLE:
+            feal_numpy.cfb_decrypt_into(cipher.subkey, register.to_bytes(8, 'big'), src[start:end], dst[start:end], segment_size_bytes)
+        else:
+            register = crypt_segments(cipher.encrypt_word, register, src[start:full], dst[start:full], segment_size_bytes, True)
+            if full < end:
+                crypt_tail(cipher.encrypt_word, register, src[full:end], dst[full:end])
+        del src, dst
+    finally:
+        src_shm.close()
+        dst_shm.close()
+
+def crypt_parallel(worker, args, data, out, step, workers, executor):
+    # Copy data into shared memory, run worker(*args, src_name, dst_name,
+    # length, start, end) on each step-sized range in a process pool (the
+    # given executor, or a new one of workers processes) and collect the
+    # output into out, or a new bytearray, which is returned.
+    length = len(data)
+    buffer = output_buffer(length, out)
+    src_shm = SharedMemory(create=True, size=length)
+    dst_shm = SharedMemory(create=True, size=length)
+    pool = None
+    try:
+        src_shm.buf[:length] = data
+        pool = executor or ProcessPoolExecutor(workers)
+        futures = [pool.submit(worker, *args, src_shm.name, dst_shm.name, length, start, min(start + step, length))
+                   for start in range(0, length, step)]
+        for future in futures:
+            future.result()
+        memoryview(buffer).cast('B')[:length] = dst_shm.buf[:length]
+    finally:
+        if pool is not None and executor is None:
+            pool.shutdown()
+        for shm in (src_shm, dst_shm):
+            shm.close()
+            shm.unlink()
+
+    return buffer
+
+@instrument.timed('cfb_decrypt')
+def cfb_decrypt_parallel(key, iv, ciphertext, segment_size, out=None, workers=None, executor=None):
+    # CFB decryption only depends on ciphertext, so the ciphertext is split
+    # into one segment-aligned range per worker and the ranges are decrypted
+    # in a process pool over shared memory. Pass executor to reuse a pool
+    # across calls. Output is identical to cfb_decrypt.
+    segment_size_bytes = check_segment_size(segment_size)
+    workers = workers or os.cpu_count() or 1
+    length = len(ciphertext)
+    if workers <= 1 or length < PARALLEL_THRESHOLD:
+        return cfb_crypt(key, iv, ciphertext, segment_size, out, True)
+
+    segments = -(-length // segment_size_bytes)
+    step = -(-segments // workers) * segment_size_bytes
+    return crypt_parallel(decrypt_range, (bytes(key), bytes(iv), segment_size_bytes),
+                          ciphertext, out, step, workers, executor)
+
+def cfb_crypt_hash(key, iv, data, segment_size, out, decrypting, hash_factory):
+    # Run CFB over BUFFER_SIZE chunks of whole segments and feed each
+    # ciphertext chunk to the hash while it is still in cache: the input
+    # chunk (before it may be overwritten) when decrypting, the output chunk
+    # when encrypting. The register for the next chunk is the last 8 bytes
+    # of IV || ciphertext so far.
+    segment_size_bytes = check_segment_size(segment_size)
+    buffer = output_buffer(len(data), out)
+    src = memoryview(data).cast('B')
+    dst = memoryview(buffer).cast('B')
+    step = BUFFER_SIZE - BUFFER_SIZE % segment_size_bytes
+    h = hash_factory()
+    register = bytes(iv)
+
+    for i in range(0, len(src), step):
+        chunk = src[i:i + step]
+        output = dst[i:i + len(chunk)]
+        if decrypting:
+            h.update(chunk)
+            next_register = (register + bytes(chunk[-8:]))[-8:]
+            cfb_crypt(key, register, chunk, segment_size, output, True)
+        else:
+            cfb_crypt(key, register, chunk, segment_size, output, False)
+            h.update(output)
+            next_register = (register + bytes(output[-8:]))[-8:]
+        register = next_register
+
+    return buffer, h.digest()
+
+@instrument.timed('cfb_encrypt')
+def cfb_encrypt_hash(key, iv, plaintext, segment_size, out=None, hash_factory=sha256):
+    # cfb_encrypt that also hashes the ciphertext in the same pass, returning
+    # (ciphertext, digest) with digest == hash_factory(ciphertext).digest().
+    return cfb_crypt_hash(key, iv, plaintext, segment_size, out, False, hash_factory)
 
-    return plaintext
+@instrument.timed('cfb_decrypt')
+def cfb_decrypt_hash(key, iv, ciphertext, segment_size, out=None, hash_factory=sha256):
+    # cfb_decrypt that also hashes the ciphertext in the same pass, returning
+    # (plaintext, digest) with digest == hash_factory(ciphertext).digest().
+    return cfb_crypt_hash(key, iv, ciphertext, segment_size, out, True, hash_factory)
@@ -0,0 +1,91 @@
+import os
+from multiprocessing.shared_memory import SharedMemory
+
+from feal_4 import get_cipher
+from CFB import MASK64, BUFFER_SIZE, PARALLEL_THRESHOLD, output_buffer, crypt_parallel
+import feal_numpy
+import instrument
+
+# FEAL-CTR: the keystream is E(T(0)) || E(T(1)) || ... with the counter
+# block T(j) = IV + j mod 2^64, and C = P XOR keystream (so decryption is
+# the same operation). No block depends on another, so the keystream is
+# generated in bulk: vectorized with NumPy, and across processes by
+# ctr_encrypt_parallel. A final partial block uses the leading bytes of
+# its keystream block. Never reuse an IV with the same key.
+
+def ctr_xor(cipher, counter, src, dst):
+    # XOR src with the keystream starting at counter block T(counter) into
+    # dst, which may be src itself
+    n = len(src)
+    if instrument.enabled:
+        blocks = -(-n // 8)
+        instrument.count('ctr.blocks', blocks)
+        instrument.count('feal.blocks', blocks)
+    if feal_numpy.AVAILABLE and n >= feal_numpy.NUMPY_THRESHOLD * 8:
+        feal_numpy.ctr_xor_into(cipher.subkey, counter, src, dst)
+        return
+
+    encrypt_word = cipher.encrypt_word
+    for start in range(0, n, BUFFER_SIZE):
+        chunk = src[start:start + BUFFER_SIZE]
+        size = len(chunk)
+        first = counter + start // 8
+        keystream = b''.join(encrypt_word((first + j) & MASK64).to_bytes(8, 'big') for j in range(-(-size // 8)))
+        result = int.from_bytes(chunk, 'big') ^ int.from_bytes(keystream[:size], 'big')
+        dst[start:start + size] = result.to_bytes(size, 'big')
+
+def ctr_crypt(key, iv, data, out):
+    buffer = output_buffer(len(data), out)
+    dst = memoryview(buffer).cast('B')
+    ctr_xor(get_cipher(key), int.from_bytes(iv, 'big'), memoryview(data).cast('B'), dst[:len(data)])
+    return buffer
+
+@instrument.timed('ctr_encrypt')
+def ctr_encrypt(key, iv, plaintext, out=None):
+    # Compute C = P XOR keystream. Returns the ciphertext in a new
+    # bytearray, or with out, in that buffer (which may be the plaintext
+    # buffer itself).
+    return ctr_crypt(key, iv, plaintext, out)
+
+@instrument.timed('ctr_decrypt')
+def ctr_decrypt(key, iv, ciphertext, out=None):
+    # Compute P = C XOR keystream, the same operation as ctr_encrypt.
+    return ctr_crypt(key, iv, ciphertext, out)
+
+def ctr_range(key, iv, src_name, dst_name, length, start, end):
+    # Worker: XOR data[start:end] from shared memory src_name with its part
+    # of the keystream into the same range of dst_name. start is on a block
+    # boundary, so its first counter block is T(start // 8).
+    src_shm = SharedMemory(name=src_name)
+    dst_shm = SharedMemory(name=dst_name)
+    try:
+        src = src_shm.buf[:length]
+        dst = dst_shm.buf[:length]
+        counter = (int.from_bytes(iv, 'big') + start // 8) & MASK64
+        ctr_xor(get_cipher(key), counter, src[start:end], dst[start:end])
+        del src, dst
+    finally:
+        src_shm.close()
+        dst_shm.close()
+
+def ctr_crypt_parallel(key, iv, data, out, workers, executor):
+    workers = workers or os.cpu_count() or 1
+    length = len(data)
+    if workers <= 1 or length < PARALLEL_THRESHOLD:
+        return ctr_crypt(key, iv, data, out)
+
+    blocks = -(-length // 8)
+    step = -(-blocks // workers) * 8
+    return crypt_parallel(ctr_range, (bytes(key), bytes(iv)), data, out, step, workers, executor)
+
+@instrument.timed('ctr_encrypt')
+def ctr_encrypt_parallel(key, iv, plaintext, out=None, workers=None, executor=None):
+    # ctr_encrypt with the data split into one block-aligned range per
+    # worker, encrypted in a process pool over shared memory. Pass executor
+    # to reuse a pool across calls. Output is identical to ctr_encrypt.
+    return ctr_crypt_parallel(key, iv, plaintext, out, workers, executor)
+
+@instrument.timed('ctr_decrypt')
+def ctr_decrypt_parallel(key, iv, ciphertext, out=None, workers=None, executor=None):
+    # ctr_decrypt over a process pool, see ctr_encrypt_parallel.
+    return ctr_crypt_parallel(key, iv, ciphertext, out, workers, executor)
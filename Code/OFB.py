@@ -0,0 +1,131 @@
+import threading
+
+from feal_4 import get_cipher
+from CFB import BUFFER_SIZE, output_buffer
+import instrument
+
+# FEAL-OFB: the output blocks O(j) = CIPH(O(j-1)) with O(-1) = IV form the
+# keystream and C = P XOR keystream (so decryption is the same operation).
+# Each block needs the previous one, but none needs the message, so the
+# keystream can be computed ahead of time by OfbKeystream. A final partial
+# block uses the leading bytes of its keystream block. Never reuse an IV
+# with the same key.
+
+# Bytes of keystream OfbKeystream buffers by default
+KEYSTREAM_CAPACITY = 64 * 1024
+
+# Blocks generated per step of precompute(), so a consumer never waits long
+# for the background thread to let go of the keystream
+PRECOMPUTE_BATCH = 512
+
+class OfbKeystream:
+    # The OFB keystream of one key and IV, consumed in order by update() and
+    # update_into(), which serve the bytes already precomputed first and
+    # generate the rest on demand. precompute() fills the buffer up to
+    # capacity bytes; with background=True a daemon thread does so from the
+    # start and again whenever fewer than low_watermark bytes remain. The
+    # concatenated output equals ofb_encrypt over the concatenated input.
+
+    def __init__(self, key, iv, capacity=KEYSTREAM_CAPACITY, low_watermark=None, background=False):
+        self.encrypt_word = get_cipher(key).encrypt_word
+        self.register = int.from_bytes(iv, 'big')
+        self.capacity = capacity
+        self.low_watermark = capacity // 2 if low_watermark is None else low_watermark
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = None
+        if background:
+            self.refill_needed = threading.Event()
+            self.refill_needed.set()
+            self.thread = threading.Thread(target=self.refill, name='ofb-keystream', daemon=True)
+            self.thread.start()
+
+    def generate(self, blocks):
+        # Advance the register by blocks output blocks and return them
+        if instrument.enabled:
+            instrument.count('ofb.blocks', blocks)
+            instrument.count('feal.blocks', blocks)
+        encrypt_word = self.encrypt_word
+        register = self.register
+        words = []
+        for _ in range(blocks):
+            register = encrypt_word(register)
+            words.append(register)
+        self.register = register
+        return b''.join(word.to_bytes(8, 'big') for word in words)
+
+    def precompute(self, size=None):
+        # Generate keystream until size bytes (at most capacity) are buffered.
+        # Returns the number of buffered bytes.
+        target = self.capacity if size is None else min(size, self.capacity)
+        while not self.closed:
+            with self.lock:
+                missing = target - len(self.buffer)
+                if missing <= 0:
+                    return len(self.buffer)
+                self.buffer += self.generate(min(-(-missing // 8), PRECOMPUTE_BATCH))
+        return len(self.buffer)
+
+    def refill(self):
+        while True:
+            self.refill_needed.wait()
+            self.refill_needed.clear()
+            if self.closed:
+                return
+            self.precompute()
+
+    def take(self, size):
+        # Remove and return the next size bytes of keystream
+        with self.lock:
+            if len(self.buffer) < size:
+                self.buffer += self.generate(-(-(size - len(self.buffer)) // 8))
+            keystream = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            remaining = len(self.buffer)
+        if self.thread is not None and remaining < self.low_watermark:
+            self.refill_needed.set()
+        return keystream
+
+    def update_into(self, chunk, out):
+        # XOR chunk with the next len(chunk) bytes of keystream into out
+        # (which may be chunk itself). Returns the number of bytes written.
+        src = memoryview(chunk).cast('B')
+        dst = memoryview(out).cast('B')
+        for start in range(0, len(src), BUFFER_SIZE):
+            part = src[start:start + BUFFER_SIZE]
+            size = len(part)
+            result = int.from_bytes(part, 'big') ^ int.from_bytes(self.take(size), 'big')
+            dst[start:start + size] = result.to_bytes(size, 'big')
+        return len(src)
+
+    def update(self, chunk):
+        # XOR chunk with the next len(chunk) bytes of keystream
+        out = bytearray(len(chunk))
+        self.update_into(chunk, out)
+        return bytes(out)
+
+    def close(self):
+        # Stop the refill thread, if any
+        self.closed = True
+        if self.thread is not None:
+            self.refill_needed.set()
+            self.thread.join()
+
+def ofb_crypt(key, iv, data, out):
+    buffer = output_buffer(len(data), out)
+    OfbKeystream(key, iv, capacity=0).update_into(data, memoryview(buffer).cast('B')[:len(data)])
+    return buffer
+
+@instrument.timed('ofb_encrypt')
+def ofb_encrypt(key, iv, plaintext, out=None):
+    # Compute C = P XOR keystream. Returns the ciphertext in a new
+    # bytearray, or with out, in that buffer (which may be the plaintext
+    # buffer itself). To have the keystream ready before the message, use
+    # OfbKeystream(key, iv).precompute() and then its update().
+    return ofb_crypt(key, iv, plaintext, out)
+
+@instrument.timed('ofb_decrypt')
+def ofb_decrypt(key, iv, ciphertext, out=None):
+    # Compute P = C XOR keystream, the same operation as ofb_encrypt.
+    return ofb_crypt(key, iv, ciphertext, out)
@@ -0,0 +1,168 @@
+import argparse
+import asyncio
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+import envelope
+from ec_elgamal import generate_system, generate_keys, system_table
+from merkle_hellman_knapsack import cached_byte_tables, generate_key_pair
+
+""" Asyncio front end for sealing and opening mail. FEAL and big-integer
+    work runs in a process pool whose workers build the FEAL tables,
+    Merkle-Hellman subset-sum tables and ElGamal g tables at start-up; a
+    semaphore bounds the messages in flight so producers wait instead of
+    queueing without limit. A length-prefixed TCP server stands in for the
+    relay to measure end-to-end throughput.
+"""
+
+# Messages processed at once by one Pipeline
+MAX_IN_FLIGHT = 64
+
+def warm_worker(public_keys, systems):
+    # Process pool initializer: importing envelope built the FEAL tables;
+    # precompute the per-key tables every job will use
+    for public_key in public_keys:
+        cached_byte_tables(tuple(public_key))
+    for system in systems:
+        system_table(system)
+
+class Pipeline:
+    """ Runs envelope.seal/open in a process pool with bounded concurrency.
+
+        public_keys and systems are the recipient Merkle-Hellman keys and
+        sender ElGamal systems to precompute in every worker.
+    """
+
+    def __init__(self, workers=None, max_in_flight=MAX_IN_FLIGHT, public_keys=(), systems=()):
+        self.executor = ProcessPoolExecutor(workers or os.cpu_count() or 1, initializer=warm_worker,
+                                            initargs=(list(public_keys), list(systems)))
+        self.max_in_flight = max_in_flight
+        self.semaphore = None
+
+    async def run(self, function, *args):
+        # Created lazily so the semaphore belongs to the running event loop
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def seal(self, message, recipient_pub, sender_sig_key):
+        """ envelope.seal in the pool; sender_sig_key must be a (system, private_key) pair. """
+        return await self.run(envelope.seal, message, recipient_pub, sender_sig_key)
+
+    async def open(self, data, recipient_key, sender_pub):
+        """ envelope.open in the pool. """
+        return await self.run(envelope.open, data, recipient_key, sender_pub)
+
+    async def seal_many(self, messages, recipient_pub, sender_sig_key):
+        return await asyncio.gather(*(self.seal(message, recipient_pub, sender_sig_key) for message in messages))
+
+    async def open_or_error(self, data, recipient_key, sender_pub):
+        # The message, or the ValueError of a malformed or forged envelope
+        try:
+            return await self.open(data, recipient_key, sender_pub)
+        except ValueError as error:
+            return error
+
+    async def open_many(self, envelopes, recipient_key, sender_pub):
+        """ Like envelope.open_many: one result per envelope, in order, the
+            message or the ValueError of an envelope that failed to open.
+        """
+        return await asyncio.gather(*(self.open_or_error(data, recipient_key, sender_pub) for data in envelopes))
+
+    def close(self):
+        self.executor.shutdown()
+
+_default_pipeline = None
+
+def default_pipeline():
+    """ Returns the process-wide Pipeline, created on first use. """
+    global _default_pipeline
+    if _default_pipeline is None:
+        _default_pipeline = Pipeline()
+    return _default_pipeline
+
+async def seal_async(message, recipient_pub, sender_sig_key):
+    """ Seals a message on the default pipeline. """
+    return await default_pipeline().seal(message, recipient_pub, sender_sig_key)
+
+async def open_async(data, recipient_key, sender_pub):
+    """ Opens an envelope on the default pipeline. """
+    return await default_pipeline().open(data, recipient_key, sender_pub)
+
+
+##### Relay stand-in: each frame is a 4-byte length followed by the payload #####
+
+async def read_frame(reader):
+    (length,) = struct.unpack('>I', await reader.readexactly(4))
+    return await reader.readexactly(length)
+
+def write_frame(writer, payload):
+    writer.write(struct.pack('>I', len(payload)) + payload)
+
+async def serve(pipeline, recipient_pub, sender_sig_key, host='127.0.0.1', port=0):
+    """ Starts a server that seals every message frame it receives and
+        replies with the envelope, in order, per connection.
+    """
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    message = await read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                write_frame(writer, await pipeline.seal(message, recipient_pub, sender_sig_key))
+                await writer.drain()
+        except (asyncio.CancelledError, ConnectionError):
+            pass  # server shutting down or client gone
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+async def run_load(host, port, messages, connections):
+    """ Sends messages over several connections and returns (envelopes, seconds). """
+    async def client(chunk):
+        reader, writer = await asyncio.open_connection(host, port)
+        replies = []
+        for message in chunk:
+            write_frame(writer, message)
+            await writer.drain()
+            replies.append(await read_frame(reader))
+        writer.close()
+        await writer.wait_closed()
+        return replies
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(client(messages[i::connections]) for i in range(connections)))
+    return [reply for replies in results for reply in replies], time.perf_counter() - start
+
+async def demo(count, size, connections, workers):
+    recipient_key, recipient_pub = generate_key_pair(64)
+    system = generate_system(128, sha256())
+    private_key, public_key = generate_keys(system)
+    pipeline = Pipeline(workers, public_keys=[recipient_pub], systems=[system])
+    server = await serve(pipeline, recipient_pub, (system, private_key))
+    host, port = server.sockets[0].getsockname()[:2]
+    try:
+        messages = [os.urandom(size) for _ in range(count)]
+        envelopes, seconds = await run_load(host, port, messages, connections)
+        opened = await pipeline.open_many(envelopes, recipient_key, (system, public_key))
+        assert sorted(opened) == sorted(messages)
+        print(f"{count} messages of {size} bytes over {connections} connections: "
+              f"{count / seconds:.1f} msg/s, {count * size / seconds / 1e6:.2f} MB/s")
+    finally:
+        server.close()
+        await server.wait_closed()
+        pipeline.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure sealing throughput through a local TCP relay stand-in.")
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--size', type=int, default=4096)
+    parser.add_argument('--connections', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+    asyncio.run(demo(args.messages, args.size, args.connections, args.workers))
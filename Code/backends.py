@@ -0,0 +1,398 @@
+import argparse
+import atexit
+import collections
+import json
+import math
+import os
+import platform
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import resource_tracker
+import CFB
+import CTR
+import ec_arith
+import ec_elgamal
+import ec_signature
+import elgamal_params
+import feal_4
+import feal_numpy
+import modular
+import utils
+
+""" One place to choose between the implementations of an operation.
+
+    Every operation (FEAL encryption and decryption, CFB decryption, CTR,
+    curve scalar multiplication and multi-exponentiation) has a registry of
+    backends that take the same arguments and give the same result, the
+    first registered being the reference. calibrate() times each backend on
+    a few input sizes and keeps the fastest per size; the choices are cached
+    to disk and reused while the machine, Python and the set of backends are
+    unchanged. apply() turns the choices into the thresholds that feal_4,
+    CFB, CTR and ec_elgamal already dispatch on, and get(operation, size)
+    returns the chosen function, calibrating on first use. Scalar
+    multiplication is not calibrated, only self-tested: self_test() checks
+    every backend against the reference and against feal_4, cfb_encrypt and
+    the signature code.
+"""
+
+DEFAULT_CALIBRATION_PATH = os.environ.get(
+    'BACKENDS_CALIBRATION',
+    os.path.join(os.path.expanduser('~'), '.cache', 'feal_backends.json'))
+
+# Timed runs of each backend per size during calibration; the best is kept
+CALIBRATION_REPEAT = 3
+
+# A backend this many times slower than the best is not timed on larger sizes
+DROP_FACTOR = 8
+
+Operation = collections.namedtuple('Operation', 'sizes sample check test_sizes backends')
+
+OPERATIONS = {}
+
+def operation(name, sizes, sample, check=None, test_sizes=None):
+    """ Declares an operation calibrated on sizes, or only self-tested if
+        sizes is empty. sample(size, rng) returns an argument tuple of that
+        size; check(args, result), if given, tells
+        whether a result is right independently of the backends. The
+        self-test uses test_sizes, sizes by default.
+    """
+    OPERATIONS[name] = Operation(sizes, sample, check, test_sizes or sizes, {})
+
+def register(operation, name, function, available=True):
+    """ Adds a backend to an operation unless it is unavailable here (a
+        missing optional dependency, a single CPU). The first backend
+        registered for an operation is its reference.
+    """
+    if available:
+        OPERATIONS[operation].backends[name] = function
+
+def backends(operation):
+    """ Returns the names of the backends of an operation, reference first. """
+    return list(OPERATIONS[operation].backends)
+
+##### Process pool for the multiprocess backends #####
+
+WORKERS = os.cpu_count() or 1
+
+_pool = None
+
+def process_pool():
+    """ Returns the shared pool of the multiprocess backends, started on first use. """
+    global _pool
+    if _pool is None:
+        # Start the resource tracker first so forked workers share it;
+        # otherwise each starts its own on attaching to the shared memory of
+        # CFB.crypt_parallel and unlinks the blocks when it exits
+        resource_tracker.ensure_running()
+        _pool = ProcessPoolExecutor(WORKERS)
+        atexit.register(_pool.shutdown)
+    return _pool
+
+##### FEAL #####
+
+def feal_blocks(data, subkey, decrypting):
+    # Encrypt or decrypt whole blocks without padding or stripping, with the
+    # fastest in-process engine
+    if feal_numpy.AVAILABLE:
+        return (feal_numpy.decrypt if decrypting else feal_numpy.encrypt)(data, subkey)
+    crypt_word = feal_4.decrypt_word if decrypting else feal_4.encrypt_word
+    words = feal_4.subkey_words(subkey)
+    return b''.join(crypt_word(int.from_bytes(data[k:k + 8], 'big'), words).to_bytes(8, 'big')
+                    for k in range(0, len(data), 8))
+
+def feal_word_encrypt(data, subkey):
+    data = feal_4.pad(data)
+    words = feal_4.subkey_words(subkey)
+    return b''.join(feal_4.encrypt_word(int.from_bytes(data[k:k + 8], 'big'), words).to_bytes(8, 'big')
+                    for k in range(0, len(data), 8))
+
+def feal_word_decrypt(data, subkey):
+    words = feal_4.subkey_words(subkey)
+    return b''.join(feal_4.decrypt_word(int.from_bytes(data[k:k + 8], 'big'), words).to_bytes(8, 'big')
+                    for k in range(0, len(data) // 8 * 8, 8)).strip(b'\x00')
+
+def feal_parallel(data, subkey, decrypting):
+    # One block-aligned chunk per worker
+    step = -(-len(data) // 8 // WORKERS) * 8 or 8
+    chunks = [data[k:k + step] for k in range(0, len(data), step)]
+    return b''.join(process_pool().map(feal_blocks, chunks, repeat(subkey), repeat(decrypting)))
+
+def sample_feal(size, rng):
+    key = rng.randbytes(8)
+    return (rng.randbytes(size), feal_4.key_generation(key))
+
+def sample_feal_ciphertext(size, rng):
+    data, subkey = sample_feal(size, rng)
+    return (feal_4.encrypt(data, subkey), subkey)
+
+operation('feal_encrypt', [64, 1024, 16 * 1024, 256 * 1024], sample_feal,
+          lambda args, result: result == feal_4.encrypt(*args), [0, 1, 13, 64, 1024, 16 * 1024])
+register('feal_encrypt', 'reference', feal_4.encrypt_reference)
+register('feal_encrypt', 'word', feal_word_encrypt)
+register('feal_encrypt', 'numpy', lambda data, subkey: feal_numpy.encrypt(feal_4.pad(data), subkey),
+         feal_numpy.AVAILABLE)
+register('feal_encrypt', 'multiprocess', lambda data, subkey: feal_parallel(feal_4.pad(data), subkey, False),
+         WORKERS > 1)
+
+operation('feal_decrypt', [64, 1024, 16 * 1024, 256 * 1024], sample_feal_ciphertext,
+          lambda args, result: result == feal_4.decrypt(*args), [0, 1, 13, 64, 1024, 16 * 1024])
+register('feal_decrypt', 'reference', feal_4.decrypt_reference)
+register('feal_decrypt', 'word', feal_word_decrypt)
+register('feal_decrypt', 'numpy', lambda data, subkey: feal_numpy.decrypt(data[:len(data) // 8 * 8], subkey).strip(b'\x00'),
+         feal_numpy.AVAILABLE)
+register('feal_decrypt', 'multiprocess', lambda data, subkey: feal_parallel(data[:len(data) // 8 * 8], subkey, True).strip(b'\x00'),
+         WORKERS > 1)
+
+##### Modes #####
+
+def sample_cfb(size, rng):
+    key, iv = rng.randbytes(8), rng.randbytes(8)
+    return (key, iv, CFB.cfb_encrypt(key, iv, rng.randbytes(size), 64), 64)
+
+operation('cfb_decrypt', [1024, 64 * 1024, 1024 * 1024], sample_cfb,
+          lambda args, result: CFB.cfb_encrypt(args[0], args[1], result, args[3]) == args[2],
+          [0, 13, 1024, 1024 * 1024 + 13])
+register('cfb_decrypt', 'inprocess', CFB.cfb_decrypt)
+register('cfb_decrypt', 'multiprocess',
+         lambda key, iv, data, segment_size: CFB.cfb_decrypt_parallel(key, iv, data, segment_size, executor=process_pool()),
+         WORKERS > 1)
+
+def sample_ctr(size, rng):
+    return (rng.randbytes(8), rng.randbytes(8), rng.randbytes(size))
+
+operation('ctr_encrypt', [1024, 64 * 1024, 1024 * 1024], sample_ctr,
+          lambda args, result: CTR.ctr_decrypt(args[0], args[1], result) == args[2],
+          [0, 13, 1024, 1024 * 1024 + 13])
+register('ctr_encrypt', 'inprocess', CTR.ctr_encrypt)
+register('ctr_encrypt', 'multiprocess',
+         lambda key, iv, data: CTR.ctr_encrypt_parallel(key, iv, data, executor=process_pool()),
+         WORKERS > 1)
+
+##### Curve and modular arithmetic #####
+
+def sample_point(size, rng):
+    return (rng.randrange(1, utils.curve.n), ec_arith.scalar_base_mult(rng.randrange(1, utils.curve.n)))
+
+# Only self-tested: nothing dispatches on a calibrated scalar_mult, the
+# signature code always uses ec_arith's Straus and Pippenger sums
+operation('scalar_mult', [], sample_point, test_sizes=[256])
+register('scalar_mult', 'reference', utils.scalar_mult)
+register('scalar_mult', 'jacobian', lambda k, point: ec_arith.to_affine(ec_arith.scalar_mult_jacobian(k, ec_arith.to_jacobian(point))))
+register('scalar_mult', 'straus', ec_arith.scalar_mult)
+
+def sample_pow(size, rng):
+    modulus = rng.getrandbits(size) | (1 << (size - 1)) | 1
+    return ([(rng.randrange(2, modulus), rng.getrandbits(size) | 1) for _ in range(2)], modulus)
+
+def builtin_multi_pow(pairs, modulus):
+    result = 1
+    for base, exponent in pairs:
+        result = result * pow(base, exponent, modulus) % modulus
+    return result
+
+operation('multi_pow', [256, 1024, 2048], sample_pow)
+register('multi_pow', 'builtin', builtin_multi_pow)
+register('multi_pow', 'sliding_window', modular.multi_pow_windows)
+
+##### Calibration #####
+
+def measure(function, args):
+    function(*args)  # warm up caches and pools
+    best = float('inf')
+    for _ in range(CALIBRATION_REPEAT):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def fingerprint():
+    # Calibration is only reused on the same machine, Python and backends
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'cpus': WORKERS,
+            'backends': {name: backends(name) for name in OPERATIONS}}
+
+def calibrate(path=DEFAULT_CALIBRATION_PATH, operations=None, seed=0):
+    """ Times the backends of the given operations (all by default) on each
+        of their sizes, saves the result to path (unless it is None) and
+        returns it. Backends DROP_FACTOR times slower than the best are not
+        timed on larger sizes.
+    """
+    rng = random.Random(seed)
+    timings, choices = {}, {}
+    for name in operations or [name for name, op in OPERATIONS.items() if op.sizes]:
+        op = OPERATIONS[name]
+        candidates = dict(op.backends)
+        timings[name], choices[name] = {}, []
+        for size in op.sizes:
+            args = op.sample(size, rng)
+            times = {backend: measure(function, args) for backend, function in candidates.items()}
+            best = min(times, key=times.get)
+            timings[name][str(size)] = times
+            choices[name].append([size, best])
+            candidates = {backend: function for backend, function in candidates.items()
+                          if times[backend] <= times[best] * DROP_FACTOR}
+    calibration = {'fingerprint': fingerprint(), 'choices': choices, 'timings': timings}
+    if path:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(calibration, f, indent=1)
+        os.replace(temp, path)
+    return calibration
+
+def load_calibration(path=DEFAULT_CALIBRATION_PATH):
+    """ Returns the calibration saved at path, or None if there is none or it
+        was made for another machine, Python or set of backends.
+    """
+    try:
+        with open(path) as f:
+            calibration = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if calibration.get('fingerprint') != fingerprint():
+        return None
+    return calibration
+
+_choices = None
+
+def choices():
+    """ Returns {operation: [[size, backend], ...]}, loading the cached
+        calibration or calibrating on first use.
+    """
+    global _choices
+    if _choices is None:
+        calibration = load_calibration() or calibrate()
+        _choices = calibration['choices']
+    return _choices
+
+def select(operation, size):
+    """ Returns the name of the backend calibrated as fastest for inputs of
+        about size: the choice for the largest calibrated size not above it.
+    """
+    table = choices().get(operation)
+    if not table:
+        return backends(operation)[0]
+    chosen = table[0][1]
+    for calibrated, backend in table:
+        if calibrated <= size:
+            chosen = backend
+    return chosen if chosen in OPERATIONS[operation].backends else backends(operation)[0]
+
+def get(operation, size):
+    """ Returns the function of the fastest backend of operation for inputs
+        of about size (bytes for FEAL and the modes, modulus bits for
+        multi_pow).
+    """
+    return OPERATIONS[operation].backends[select(operation, size)]
+
+def crossover(table, fast):
+    # The smallest calibrated size from which one of the fast backends is
+    # chosen at every larger size, math.inf if the largest size does not
+    # choose one, None without a calibration
+    if not table:
+        return None
+    threshold = math.inf
+    for size, backend in table:
+        if backend not in fast:
+            threshold = math.inf
+        elif threshold == math.inf:
+            threshold = size
+    return threshold
+
+def apply(calibration=None):
+    """ Sets feal_numpy.NUMPY_THRESHOLD, CFB.PARALLEL_THRESHOLD,
+        CTR.PARALLEL_THRESHOLD and modular.MULTI_POW_MIN_BITS from the
+        crossovers of a calibration, the cached one by default, so the
+        dispatchers take the backend calibrated as fastest. Thresholds of
+        backends unavailable here, or all of them without a calibration,
+        keep their defaults. Returns the thresholds set.
+    """
+    calibration = calibration or load_calibration()
+    if calibration is None:
+        return {}
+    choices = calibration['choices']
+    applied = {}
+    for module, name, operation, fast, unit in [
+            (feal_numpy, 'NUMPY_THRESHOLD', 'feal_encrypt', {'numpy', 'multiprocess'}, 8),
+            (CFB, 'PARALLEL_THRESHOLD', 'cfb_decrypt', {'multiprocess'}, 1),
+            (CTR, 'PARALLEL_THRESHOLD', 'ctr_encrypt', {'multiprocess'}, 1),
+            (modular, 'MULTI_POW_MIN_BITS', 'multi_pow', {'sliding_window'}, 1)]:
+        if not fast & set(OPERATIONS[operation].backends):
+            continue
+        threshold = crossover(choices.get(operation, []), fast)
+        if threshold is not None:
+            value = threshold if threshold == math.inf else -(-threshold // unit)
+            setattr(module, name, value)
+            applied['%s.%s' % (module.__name__, name)] = value
+    return applied
+
+##### Differential self-test #####
+
+def signature_failures(rng):
+    # Check the curve and modular backends through the signature equations:
+    # e * G == r * Q + s * R for EC ElGamal, g^h == y^r * r^s for ElGamal
+    failures = []
+    message = rng.randbytes(32)
+
+    d, Q = ec_signature.generate_keys()
+    R, s = signature = ec_signature.sign(d, message)
+    if not ec_signature.verify(Q, message, signature):
+        failures.append('ec_signature: verify rejected a valid signature')
+    e = ec_signature.hash_message(message)
+    for name, scalar_mult in OPERATIONS['scalar_mult'].backends.items():
+        if utils.point_add(scalar_mult(R[0] % utils.curve.n, Q), scalar_mult(s, R)) != scalar_mult(e, utils.curve.g):
+            failures.append('scalar_mult/%s: EC ElGamal signature equation' % name)
+
+    system = elgamal_params.generate_parameters(128)  # Not from the pool, which would refill
+    p, g = system
+    x, y = ec_elgamal.generate_keys(system)
+    r, s = signature = ec_elgamal.sign(system, x, message)
+    if not ec_elgamal.verify(system, y, message, signature):
+        failures.append('ec_elgamal: verify rejected a valid signature')
+    h = ec_elgamal.hash_message(message)
+    for name, multi_pow in OPERATIONS['multi_pow'].backends.items():
+        if multi_pow([(y, r), (r, s)], p) != pow(g, h, p):
+            failures.append('multi_pow/%s: ElGamal signature equation' % name)
+    return failures
+
+def self_test(seed=None):
+    """ Runs every backend of every operation on sample inputs of its test
+        sizes and compares the results with the reference backend and the
+        operation's own check, then checks the curve and modular backends
+        through the signature code. Returns a list of failures, empty when
+        all backends agree.
+    """
+    rng = random.Random(seed)
+    failures = []
+    for name, op in OPERATIONS.items():
+        for size in op.test_sizes:
+            args = op.sample(size, rng)
+            results = {backend: function(*args) for backend, function in op.backends.items()}
+            expected = next(iter(results.values()))
+            for backend, result in results.items():
+                if result != expected:
+                    failures.append('%s/%s: differs from the reference for size %d' % (name, backend, size))
+                elif op.check and not op.check(args, result):
+                    failures.append('%s/%s: check failed for size %d' % (name, backend, size))
+    return failures + signature_failures(rng)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Calibrate and self-test the backends.")
+    parser.add_argument('--calibrate', action='store_true', help="recalibrate even if a cached calibration exists")
+    parser.add_argument('--self-test', action='store_true', help="check every backend against the reference")
+    parser.add_argument('--path', default=DEFAULT_CALIBRATION_PATH)
+    args = parser.parse_args()
+
+    if args.self_test:
+        failures = self_test()
+        for failure in failures:
+            print(failure)
+        print('self-test: %d failures' % len(failures))
+        raise SystemExit(1 if failures else 0)
+
+    calibration = (None if args.calibrate else load_calibration(args.path)) or calibrate(args.path)
+    for name, table in calibration['choices'].items():
+        print('%-14s %s' % (name, ', '.join('%d: %s' % (size, backend) for size, backend in table)))
+    for name, value in apply(calibration).items():
+        print('%-30s %s' % (name, value))
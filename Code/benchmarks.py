@@ -0,0 +1,236 @@
+import argparse
+import functools
+import json
+import os
+import platform
+import sys
+import time
+from contextlib import redirect_stdout
+from hashlib import sha256
+from io import StringIO
+import CFB
+import CTR
+import OFB
+import ec_elgamal
+import elgamal_params
+import feal_4
+import main
+import merkle_hellman_knapsack as mh
+import utils
+
+""" Benchmarks for every primitive and the end-to-end flow.
+
+    python benchmarks.py [--quick | --full] [--output results.json]
+    python benchmarks.py --compare baseline.json [--threshold 0.10]
+
+    Each benchmark reports the best time per call over several repeats.
+    With --compare, any benchmark slower than the baseline by more than
+    the threshold is listed and the exit status is 1.
+"""
+
+SEGMENT_SIZES = [8, 16, 32, 64]
+MESSAGE_SIZES = [1 << 10, 64 << 10, 1 << 20]
+FULL_MESSAGE_SIZES = MESSAGE_SIZES + [16 << 20, 64 << 20]
+ELGAMAL_KEY_LENGTHS = [128, 256, 512]
+KNAPSACK_SIZES = [64, 128, 256]
+
+def measure(function, repeat=5, min_time=0.2):
+    """ Returns the best seconds per call of function() over repeat rounds,
+        each running enough calls to last at least min_time.
+    """
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time or calls >= 1 << 20:
+            break
+        calls *= 2
+    best = elapsed / calls
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best
+
+def feal_benchmarks(config):
+    key = os.urandom(8)
+    subkey = feal_4.key_generation(key)
+    block = os.urandom(8)
+    ciphertext = feal_4.encrypt(block, subkey)
+    yield 'feal_4.encrypt/block', lambda: lambda: feal_4.encrypt(block, subkey), {}
+    yield 'feal_4.decrypt/block', lambda: lambda: feal_4.decrypt(ciphertext, subkey), {}
+
+def cfb_benchmarks(config):
+    key, iv = os.urandom(8), os.urandom(8)
+    message = functools.lru_cache(None)(os.urandom)
+
+    @functools.lru_cache(None)
+    def ciphertext(size, segment_size):
+        return CFB.cfb_encrypt(key, iv, message(size), segment_size)
+
+    for size in config['message_sizes']:
+        for segment_size in SEGMENT_SIZES:
+            params = {'bytes': size, 'segment_size': segment_size}
+            yield ('cfb_encrypt/%d/%d' % (segment_size, size),
+                   lambda n=size, s=segment_size: lambda m=message(n): CFB.cfb_encrypt(key, iv, m, s), params)
+            yield ('cfb_decrypt/%d/%d' % (segment_size, size),
+                   lambda n=size, s=segment_size: lambda c=ciphertext(n, s): CFB.cfb_decrypt(key, iv, c, s), params)
+            yield ('cfb_encrypt_hash/%d/%d' % (segment_size, size),
+                   lambda n=size, s=segment_size: lambda m=message(n): CFB.cfb_encrypt_hash(key, iv, m, s), params)
+            yield ('cfb_decrypt_hash/%d/%d' % (segment_size, size),
+                   lambda n=size, s=segment_size: lambda c=ciphertext(n, s): CFB.cfb_decrypt_hash(key, iv, c, s), params)
+
+def stream_mode_benchmarks(config):
+    key, iv = os.urandom(8), os.urandom(8)
+    message = functools.lru_cache(None)(os.urandom)
+    for size in config['message_sizes']:
+        params = {'bytes': size}
+        yield 'ctr_encrypt/%d' % size, lambda n=size: lambda m=message(n): CTR.ctr_encrypt(key, iv, m), params
+        yield 'ofb_encrypt/%d' % size, lambda n=size: lambda m=message(n): OFB.ofb_encrypt(key, iv, m), params
+
+def curve_benchmarks(config):
+    k = int.from_bytes(os.urandom(32), 'big') % utils.curve.n
+    point = utils.scalar_mult(3, utils.curve.g)
+    yield 'utils.scalar_mult/generator', lambda: lambda: utils.scalar_mult(k, utils.curve.g), {}
+    yield 'utils.scalar_mult/point', lambda: lambda: utils.scalar_mult(k, point), {}
+
+def elgamal_benchmarks(config):
+    message = sha256(b'benchmark').digest()
+
+    @functools.lru_cache(None)
+    def keys(key_length):
+        # A fresh system rather than ec_elgamal.generate_system, whose pool
+        # would start a refill thread competing with the timed calls
+        system = elgamal_params.generate_parameters(key_length)
+        private_key, public_key = ec_elgamal.generate_keys(system)
+        return system, private_key, public_key, ec_elgamal.sign(system, private_key, message)
+
+    def sign(key_length):
+        system, private_key, _, _ = keys(key_length)
+        return lambda: ec_elgamal.sign(system, private_key, message)
+
+    def verify(key_length):
+        system, _, public_key, signature = keys(key_length)
+        return lambda: ec_elgamal.verify(system, public_key, message, signature)
+
+    for key_length in config['elgamal_key_lengths']:
+        params = {'key_length': key_length}
+        yield 'ec_elgamal.sign/%d' % key_length, functools.partial(sign, key_length), params
+        yield 'ec_elgamal.verify/%d' % key_length, functools.partial(verify, key_length), params
+
+def knapsack_benchmarks(config):
+    @functools.lru_cache(None)
+    def keys(n):
+        private_key, public_key = mh.generate_key_pair(n, seed=n)
+        key = os.urandom(n // 8)
+        bits = ''.join(format(byte, '08b') for byte in key)
+        return private_key, public_key, key, bits, mh.encrypt(bits, public_key)
+
+    def encrypt(n):
+        _, public_key, _, bits, _ = keys(n)
+        return lambda: mh.encrypt(bits, public_key)
+
+    def encrypt_bytes(n):
+        _, public_key, key, _, _ = keys(n)
+        return lambda: mh.encrypt_bytes(key, public_key)
+
+    def decrypt(n):
+        K, _, _, _, ciphertext = keys(n)
+        return lambda: mh.decrypt(ciphertext, K.sequence, K.q, K.r)
+
+    def decrypt_bytes(n):
+        K, _, _, _, ciphertext = keys(n)
+        return lambda: K.decrypt_bytes(ciphertext)
+
+    for n in KNAPSACK_SIZES:
+        params = {'elements': n}
+        yield 'mh.keygen/%d' % n, lambda n=n: lambda: mh.generate_key_pair(n), params
+        yield 'mh.encrypt/%d' % n, functools.partial(encrypt, n), params
+        yield 'mh.encrypt_bytes/%d' % n, functools.partial(encrypt_bytes, n), params
+        yield 'mh.decrypt/%d' % n, functools.partial(decrypt, n), params
+        yield 'mh.PrivateKey.decrypt_bytes/%d' % n, functools.partial(decrypt_bytes, n), params
+
+def end_to_end_benchmarks(config):
+    message = os.urandom(768).hex()[:1024].encode()  # main.run prints it as UTF-8
+
+    def setup():
+        # Keys are made once, outside the parameter pool, so only the seal
+        # and open flow is timed
+        mh_private_key, mh_public_key = mh.generate_key_pair(64, seed=64)
+        system = elgamal_params.generate_parameters(128)
+        keys = (mh_private_key, mh_public_key, system, ec_elgamal.generate_keys(system))
+
+        def flow():
+            with redirect_stdout(StringIO()):
+                main.run(message, keys)
+
+        return flow
+
+    yield 'main.run/1024', setup, {'bytes': 1024}
+
+GROUPS = [feal_benchmarks, cfb_benchmarks, stream_mode_benchmarks, curve_benchmarks,
+          elgamal_benchmarks, knapsack_benchmarks, end_to_end_benchmarks]
+
+def run(config, pattern=None):
+    """ Runs every benchmark whose name contains pattern, returning a results dict.
+
+        Each group yields (name, setup, params), where setup() builds the
+        inputs and returns the function to time, so benchmarks left out by
+        pattern cost nothing.
+    """
+    results = {}
+    for group in GROUPS:
+        for name, setup, params in group(config):
+            if pattern and pattern not in name:
+                continue
+            seconds = measure(setup(), config['repeat'], config['min_time'])
+            results[name] = dict(params, seconds=seconds)
+            print('%-45s %12.3f us' % (name, seconds * 1e6), file=sys.stderr)
+    return {'python': platform.python_version(), 'machine': platform.machine(), 'results': results}
+
+def compare(current, baseline, threshold):
+    """ Returns (name, baseline seconds, current seconds) for every benchmark
+        more than threshold slower than in baseline.
+    """
+    regressions = []
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before and result['seconds'] > before['seconds'] * (1 + threshold):
+            regressions.append((name, before['seconds'], result['seconds']))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the crypto primitives and the end-to-end flow.")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument('--quick', action='store_true', help="1 KB messages only, fewer repeats")
+    size.add_argument('--full', action='store_true', help="messages up to 64 MB")
+    parser.add_argument('--filter', help="only run benchmarks whose name contains this")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="baseline JSON file to check for regressions")
+    parser.add_argument('--threshold', type=float, default=0.10, help="allowed slowdown (default 0.10)")
+    args = parser.parse_args()
+
+    config = {
+        'message_sizes': FULL_MESSAGE_SIZES if args.full else [1 << 10] if args.quick else MESSAGE_SIZES,
+        'elgamal_key_lengths': ELGAMAL_KEY_LENGTHS[:1] if args.quick else ELGAMAL_KEY_LENGTHS,
+        'repeat': 3 if args.quick else 5,
+        'min_time': 0.05 if args.quick else 0.2,
+    }
+    current = run(config, args.filter)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+    else:
+        json.dump(current, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(current, json.load(f), args.threshold)
+        for name, before, after in regressions:
+            print('REGRESSION %s: %.3f us -> %.3f us (%+.0f%%)' % (name, before * 1e6, after * 1e6, (after / before - 1) * 100),
+                  file=sys.stderr)
+        sys.exit(1 if regressions else 0)
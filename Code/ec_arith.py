@@ -0,0 +1,315 @@
+from utils import curve, is_on_curve
+from modular import inverse, invert_many
+import instrument
+
+""" Faster arithmetic on utils.curve: Jacobian coordinates, wNAF for
+    variable-base points and a precomputed table for the generator.
+    Results match utils.scalar_mult; None is the point at infinity.
+"""
+
+# wNAF window width for variable-base scalar multiplication
+WNAF_WIDTH = 5
+
+# Digit width of the precomputed generator table
+BASE_WINDOW = 4
+
+# Number of terms from which multi_scalar_mult switches from Straus to Pippenger
+PIPPENGER_THRESHOLD = 32
+
+
+##### Jacobian coordinates: (X, Y, Z) stands for (X / Z^2, Y / Z^3) #####
+
+def to_jacobian(point):
+    """Returns the Jacobian form of an affine point."""
+    if point is None:
+        return None
+    x, y = point
+    return (x, y, 1)
+
+
+def to_affine(point):
+    """Returns the affine form of a Jacobian point."""
+    if point is None:
+        return None
+    X, Y, Z = point
+    p = curve.p
+    z_inv = inverse(Z, p)
+    z_inv2 = z_inv * z_inv % p
+    return (X * z_inv2 % p, Y * z_inv2 * z_inv % p)
+
+
+def to_affine_many(points):
+    """Returns the affine forms of many Jacobian points with one inversion."""
+    p = curve.p
+    finite = [point for point in points if point is not None]
+    inverses = iter(invert_many([Z for _, _, Z in finite], p))
+    result = []
+    for point in points:
+        if point is None:
+            result.append(None)
+            continue
+        X, Y, _ = point
+        z_inv = next(inverses)
+        z_inv2 = z_inv * z_inv % p
+        result.append((X * z_inv2 % p, Y * z_inv2 * z_inv % p))
+    return result
+
+
+def jacobian_neg(point):
+    """Returns -point."""
+    if point is None:
+        return None
+    X, Y, Z = point
+    return (X, -Y % curve.p, Z)
+
+
+def jacobian_double(point):
+    """Returns 2 * point."""
+    if point is None:
+        return None
+    if instrument.enabled:
+        instrument.count('ec.point_double')
+    X, Y, Z = point
+    if Y == 0:
+        return None
+    p = curve.p
+    YY = Y * Y % p
+    S = 4 * X * YY % p
+    ZZ = Z * Z % p
+    M = (3 * X * X + curve.a * ZZ * ZZ) % p
+    X3 = (M * M - 2 * S) % p
+    Y3 = (M * (S - X3) - 8 * YY * YY) % p
+    Z3 = 2 * Y * Z % p
+    return (X3, Y3, Z3)
+
+
+def jacobian_add(point1, point2):
+    """Returns point1 + point2 for two Jacobian points."""
+    if point1 is None:
+        return point2
+    if point2 is None:
+        return point1
+
+    p = curve.p
+    if instrument.enabled:
+        instrument.count('ec.point_add')
+    X1, Y1, Z1 = point1
+    X2, Y2, Z2 = point2
+    Z1Z1 = Z1 * Z1 % p
+    Z2Z2 = Z2 * Z2 % p
+    U1 = X1 * Z2Z2 % p
+    U2 = X2 * Z1Z1 % p
+    S1 = Y1 * Z2 * Z2Z2 % p
+    S2 = Y2 * Z1 * Z1Z1 % p
+
+    if U1 == U2:
+        if S1 != S2:
+            # point1 + (-point1) = 0
+            return None
+        return jacobian_double(point1)
+
+    H = U2 - U1
+    R = S2 - S1
+    HH = H * H % p
+    HHH = H * HH % p
+    V = U1 * HH % p
+    X3 = (R * R - HHH - 2 * V) % p
+    Y3 = (R * (V - X3) - S1 * HHH) % p
+    Z3 = H * Z1 * Z2 % p
+    return (X3, Y3, Z3)
+
+
+def jacobian_add_affine(point1, point2):
+    """Returns point1 + point2 for a Jacobian point1 and an affine point2."""
+    if point2 is None:
+        return point1
+    if point1 is None:
+        return to_jacobian(point2)
+
+    p = curve.p
+    if instrument.enabled:
+        instrument.count('ec.point_add')
+    X1, Y1, Z1 = point1
+    x2, y2 = point2
+    Z1Z1 = Z1 * Z1 % p
+    U2 = x2 * Z1Z1 % p
+    S2 = y2 * Z1 * Z1Z1 % p
+
+    if X1 == U2:
+        if Y1 != S2:
+            return None
+        return jacobian_double(point1)
+
+    H = U2 - X1
+    R = S2 - Y1
+    HH = H * H % p
+    HHH = H * HH % p
+    V = X1 * HH % p
+    X3 = (R * R - HHH - 2 * V) % p
+    Y3 = (R * (V - X3) - Y1 * HHH) % p
+    Z3 = H * Z1 % p
+    return (X3, Y3, Z3)
+
+
+##### Scalar multiplication #####
+
+def wnaf(k, width=WNAF_WIDTH):
+    """Returns the width-w NAF digits of k >= 0, least significant first."""
+    digits = []
+    window = 1 << width
+    half = window >> 1
+    while k:
+        if k & 1:
+            digit = k & (window - 1)
+            if digit >= half:
+                digit -= window
+            k -= digit
+        else:
+            digit = 0
+        digits.append(digit)
+        k >>= 1
+    return digits
+
+
+def odd_multiples(point, width=WNAF_WIDTH):
+    """Returns [P, 3P, 5P, ..., (2^(w-1) - 1)P] for a Jacobian point P."""
+    multiples = [point]
+    twice = jacobian_double(point)
+    for _ in range((1 << (width - 2)) - 1):
+        multiples.append(jacobian_add(multiples[-1], twice))
+    return multiples
+
+
+def scalar_mult_jacobian(k, point, width=WNAF_WIDTH):
+    """Returns k * point for a Jacobian point, using wNAF."""
+    k %= curve.n
+    if k == 0 or point is None:
+        return None
+
+    multiples = odd_multiples(point, width)
+    result = None
+    for digit in reversed(wnaf(k, width)):
+        result = jacobian_double(result)
+        if digit > 0:
+            result = jacobian_add(result, multiples[digit >> 1])
+        elif digit < 0:
+            result = jacobian_add(result, jacobian_neg(multiples[-digit >> 1]))
+    return result
+
+
+_base_table = None
+
+def base_table():
+    """
+    Returns the generator table, built on first use: row i holds
+    j * 2^(BASE_WINDOW * i) * curve.g in affine form for j = 0 .. 2^BASE_WINDOW - 1.
+    """
+    global _base_table
+    if _base_table is None:
+        points = []
+        base = to_jacobian(curve.g)
+        for _ in range(-(-curve.n.bit_length() // BASE_WINDOW)):
+            point = None
+            for _ in range((1 << BASE_WINDOW) - 1):
+                point = jacobian_add(point, base)
+                points.append(point)
+            base = jacobian_add(point, base)
+        # One inversion normalizes the whole table
+        points = iter(to_affine_many(points))
+        row_size = (1 << BASE_WINDOW) - 1
+        _base_table = [[None] + [next(points) for _ in range(row_size)]
+                       for _ in range(-(-curve.n.bit_length() // BASE_WINDOW))]
+    return _base_table
+
+
+def scalar_base_mult(k):
+    """Returns k * curve.g in affine form using the precomputed table: one
+    mixed addition per BASE_WINDOW bits of k and no doublings."""
+    k %= curve.n
+    if k == 0:
+        return None
+
+    table = base_table()
+    mask = (1 << BASE_WINDOW) - 1
+    result = None
+    for row in table:
+        if k == 0:
+            break
+        result = jacobian_add_affine(result, row[k & mask])
+        k >>= BASE_WINDOW
+    return to_affine(result)
+
+
+def scalar_mult(k, point):
+    """Returns k * point, same result as utils.scalar_mult. The curve check
+    is done once on the input rather than on every step."""
+    assert is_on_curve(point)
+
+    if point is None or k % curve.n == 0:
+        return None
+    if point == curve.g:
+        return scalar_base_mult(k)
+    return to_affine(straus([(k % curve.n, point)]))
+
+
+##### Multi-scalar multiplication #####
+
+def straus(pairs, width=WNAF_WIDTH):
+    """Returns the Jacobian sum of k * P over (k, P) pairs of scalars and
+    affine points, sharing one chain of doublings between all terms. The
+    odd multiples of every point are normalized with one inversion so the
+    main loop only does mixed additions."""
+    p = curve.p
+    size = 1 << (width - 2)
+    multiples = to_affine_many([m for _, point in pairs for m in odd_multiples(to_jacobian(point), width)])
+    tables = [multiples[i:i + size] for i in range(0, len(multiples), size)]
+    digits = [wnaf(k, width) for k, _ in pairs]
+    result = None
+    for i in reversed(range(max(map(len, digits), default=0))):
+        result = jacobian_double(result)
+        for table, naf in zip(tables, digits):
+            if i < len(naf) and naf[i]:
+                digit = naf[i]
+                if digit > 0:
+                    result = jacobian_add_affine(result, table[digit >> 1])
+                else:
+                    x, y = table[-digit >> 1]
+                    result = jacobian_add_affine(result, (x, -y % p))
+    return result
+
+
+def pippenger(pairs):
+    """Returns the Jacobian sum of k * P over (k, P) pairs of scalars and
+    affine points with the bucket method, for large numbers of terms."""
+    c = max(2, len(pairs).bit_length() - 2)
+    mask = (1 << c) - 1
+    bits = max(k.bit_length() for k, _ in pairs)
+    result = None
+    for shift in reversed(range(0, bits, c)):
+        for _ in range(c):
+            result = jacobian_double(result)
+        buckets = [None] * mask
+        for k, point in pairs:
+            digit = (k >> shift) & mask
+            if digit:
+                buckets[digit - 1] = jacobian_add_affine(buckets[digit - 1], point)
+        # sum(j * bucket[j]) as a running sum of suffix sums
+        running = None
+        window = None
+        for bucket in reversed(buckets):
+            running = jacobian_add(running, bucket)
+            window = jacobian_add(window, running)
+        result = jacobian_add(result, window)
+    return result
+
+
+def multi_scalar_mult(pairs):
+    """Returns sum(k * P) over (k, P) pairs as a Jacobian point, using Straus
+    for a few terms and Pippenger from PIPPENGER_THRESHOLD terms on."""
+    pairs = [(k % curve.n, point) for k, point in pairs]
+    pairs = [(k, point) for k, point in pairs if k and point is not None]
+    if not pairs:
+        return None
+    if len(pairs) < PIPPENGER_THRESHOLD:
+        return straus(pairs)
+    return pippenger(pairs)
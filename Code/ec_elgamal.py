@@ -1,74 +1,29 @@
 from hashlib import sha256
 from random import randint
-from math import gcd
-from random import randrange
-from sympy import randprime
-import random  # Ensure to import the random module
+from functools import lru_cache
+import queue
+import threading
+import instrument
+import modular
+from modular import multi_pow, FixedBasePow
+from elgamal_params import default_pool
 
 """ Module for generating ElGamal Digital Signature Scheme systems, keys,
     Signing documents, and verifying signatures.
 """
 
-"""function to check if n prime"""
-def is_prime(n, k=30):
-    if n <= 3:
-        return n == 2 or n == 3
-    neg_one = n - 1
-
-    # write n-1 as 2^s*d where d is odd
-    s, d = 0, neg_one
-    while not d & 1:
-        s, d = s+1, d>>1
-    assert 2 ** s * d == neg_one and d & 1
-
-    for i in range(k):
-        a = randrange(2, neg_one)
-        x = pow(a, d, n)
-        if x in (1, neg_one):
-            continue
-        for r in range(1, s):
-            x = x ** 2 % n
-            if x == 1:
-                return False
-            if x == neg_one:
-                break
-        else:
-            return False
-    return True
-
-"""function to generate a custom prime"""
-def custom_randprime(N=10**8):
-    p = 1
-    while not is_prime(p):
-        p = randrange(N)
-    return p
+# Nonces kept ready by a Signer, and the level at which it refills
+SIGNER_POOL_SIZE = 256
+SIGNER_LOW_WATERMARK = 64
 
 """function to return the inverse of a mod m"""
 def inverse(a, m):
-    if m == 1:
-        return 0
-
-    def extended_gcd(a, b):
-        if a == 0:
-            return b, 0, 1
-        gcd, x1, y1 = extended_gcd(b % a, a)
-        x = y1 - (b // a) * x1
-        y = x1
-        return gcd, x, y
-
-    gcd, x, _ = extended_gcd(a, m)
-    if gcd != 1:
-        raise ValueError("Modular inverse does not exist.")
-    else:
-        return (x % m + m) % m
+    return modular.inverse(a, m)
 
 def generate_system(key_length, hash_function):
     """ Generates an ElGamal system """
-    # Generate a prime number p
-    p = randprime(2 ** (key_length - 1), 2 ** key_length)
-    # Generate a base g
-    g = random.randint(2, p - 2)
-    return (p, g)
+    # Take a safe prime p and a generator g from the pregenerated pool
+    return default_pool().take(key_length)
 
 def generate_keys(system):
     """ Generates a public-private key pair for an ElGamal system """
@@ -77,15 +32,23 @@ def generate_keys(system):
     public_key = pow(g, private_key, p)
     return (private_key, public_key)
 
-def sign(system, private_key, message):
-    """ Signs a message using the private key of an ElGamal system. """
+def hash_message(message, prehashed=False):
+    """ Returns the SHA-256 of a message as an integer. With prehashed=True
+        the message already is a digest and is used as is.
+    """
     if not isinstance(message, bytes):
         message = message.encode()  # Ensure the message is bytes-like
-
-    p, g = system
+    if prehashed:
+        return int.from_bytes(message, 'big')
     h = sha256()
     h.update(message)
-    message_hash = int.from_bytes(h.digest(), 'big')
+    return int.from_bytes(h.digest(), 'big')
+
+@instrument.timed('sign')
+def sign(system, private_key, message, prehashed=False):
+    """ Signs a message using the private key of an ElGamal system. """
+    p, g = system
+    message_hash = hash_message(message, prehashed)
     while True:
         k = randint(1, p - 2)
         try:
@@ -93,22 +56,112 @@ def sign(system, private_key, message):
             break
         except ValueError:
             continue  # Retry with a new k if the inverse does not exist
+    if instrument.enabled:
+        instrument.count('mod.pow')
     r = pow(g, k, p)
     s = (k_inv * (message_hash - private_key * r)) % (p - 1)
     return (r, s)
 
-def verify(system, public_key, message, signature):
-    """ Verifies a signature using the public key of an ElGamal system. """
-    if not isinstance(message, bytes):
-        message = message.encode()  # Ensure the message is bytes-like
+@lru_cache(maxsize=64)
+def system_table(system):
+    """ Returns the fixed-base table for g of a system, built once per system. """
+    p, g = system
+    return FixedBasePow(g, p, (p - 1).bit_length())
+
+def public_key_table(system, public_key):
+    """ Returns a fixed-base table for a public key, for verify(). Worth it
+        for keys that verify many signatures; see key_cache.
+    """
+    p, g = system
+    return FixedBasePow(public_key, p, p.bit_length())
 
+@instrument.timed('verify')
+def verify(system, public_key, message, signature, prehashed=False, public_table=None):
+    """ Verifies a signature using the public key of an ElGamal system,
+        optionally with its public_key_table().
+    """
     p, g = system
     r, s = signature
-    h = sha256()
-    h.update(message)
-    message_hash = int.from_bytes(h.digest(), 'big')
+    message_hash = hash_message(message, prehashed)
     if not (0 < r < p) or not (0 < s < (p - 1)):
         return False
-    v1 = pow(g, message_hash, p)
-    v2 = (pow(public_key, r, p) * pow(r, s, p)) % p
+    # g^(p-1) = 1, so the hash can be reduced before using the table for g
+    v1 = system_table(system).pow(message_hash % (p - 1))
+    if public_table is not None:
+        v2 = public_table.pow(r) * pow(r, s, p) % p
+    else:
+        v2 = multi_pow([(public_key, r), (r, s)], p)
     return v1 == v2
+
+def verify_many(system, items, prehashed=False, public_table=None):
+    """ Verifies (public_key, message, signature) triples of one system,
+        sharing its precomputed table. public_table, if given, must be the
+        public_key_table() of the one public key of all items. Returns a
+        list of booleans.
+    """
+    return [verify(system, public_key, message, signature, prehashed, public_table)
+            for public_key, message, signature in items]
+
+class Signer:
+    """ Signs with one private key using nonces precomputed in the background.
+
+        A daemon thread keeps up to pool_size entries (r, k^-1, k^-1 * x * r)
+        with r = g^k in a queue and refills it whenever fewer than
+        low_watermark remain, so sign() is one hash, one multiplication and
+        one subtraction. Every nonce is taken from the queue exactly once.
+    """
+
+    def __init__(self, system, private_key, pool_size=SIGNER_POOL_SIZE, low_watermark=SIGNER_LOW_WATERMARK):
+        self.system = system
+        self.private_key = private_key
+        self.low_watermark = low_watermark
+        self.nonces = queue.Queue(maxsize=pool_size)
+        self.refill_needed = threading.Event()
+        self.refill_needed.set()
+        self.closed = False
+        self.thread = threading.Thread(target=self.refill, name='elgamal-signer', daemon=True)
+        self.thread.start()
+
+    def make_nonce(self):
+        p, g = self.system
+        while True:
+            k = randint(1, p - 2)
+            try:
+                k_inv = inverse(k, p - 1)
+                break
+            except ValueError:
+                continue  # Retry with a new k if the inverse does not exist
+        r = system_table(self.system).pow(k)
+        return (r, k_inv, k_inv * self.private_key * r % (p - 1))
+
+    def refill(self):
+        while True:
+            self.refill_needed.wait()
+            self.refill_needed.clear()
+            if self.closed:
+                return
+            while not self.closed:
+                nonce = self.make_nonce()
+                try:
+                    self.nonces.put_nowait(nonce)
+                except queue.Full:
+                    break  # Only this thread adds, so the spare nonce is dropped unused
+
+    @instrument.timed('sign')
+    def sign(self, message, prehashed=False):
+        """ Signs a message, same signature equation as sign(). """
+        try:
+            r, k_inv, k_inv_xr = self.nonces.get_nowait()
+        except queue.Empty:
+            r, k_inv, k_inv_xr = self.make_nonce()
+        if self.nonces.qsize() < self.low_watermark:
+            self.refill_needed.set()
+
+        message_hash = hash_message(message, prehashed)
+        s = (k_inv * message_hash - k_inv_xr) % (self.system[0] - 1)
+        return (r, s)
+
+    def close(self):
+        """ Stops the refill thread. """
+        self.closed = True
+        self.refill_needed.set()
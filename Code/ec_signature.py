@@ -0,0 +1,86 @@
+from hashlib import sha256
+import secrets
+import instrument
+from utils import curve, is_on_curve
+from modular import inverse
+from ec_arith import scalar_base_mult, multi_scalar_mult, jacobian_add_affine, to_affine
+
+""" EC ElGamal signatures on utils.curve (P-256).
+
+    A signature is (R, s) with R = k * G and r = x(R) mod n, where
+    s = k^-1 * (e - d * r) mod n for the message hash e and private key d.
+    It is valid when e * G == r * Q + s * R for the public key Q = d * G.
+    Keeping the whole point R lets many signatures be checked together.
+"""
+
+# Bits of each random multiplier used by verify_batch
+BATCH_RANDOMIZER_BITS = 128
+
+def hash_message(message, prehashed=False):
+    """ Hashes a message to an integer modulo the curve order. With
+        prehashed=True the message already is a digest and is not hashed again.
+    """
+    if not isinstance(message, bytes):
+        message = message.encode()  # Ensure the message is bytes-like
+    if not prehashed:
+        message = sha256(message).digest()
+    return int.from_bytes(message, 'big') % curve.n
+
+def generate_keys():
+    """ Generates a (private_key, public_key) pair on the curve. """
+    private_key = secrets.randbelow(curve.n - 1) + 1
+    return (private_key, scalar_base_mult(private_key))
+
+@instrument.timed('ec_sign')
+def sign(private_key, message, prehashed=False):
+    """ Signs a message with a private key, returning (R, s). """
+    e = hash_message(message, prehashed)
+    while True:
+        k = secrets.randbelow(curve.n - 1) + 1
+        R = scalar_base_mult(k)
+        r = R[0] % curve.n
+        s = inverse(k, curve.n) * (e - private_key * r) % curve.n
+        if r and s:
+            return (R, s)
+
+def valid_signature_values(public_key, signature):
+    """ Checks the points are on the curve and the scalars are in range. """
+    R, s = signature
+    if public_key is None or R is None:
+        return False
+    if not (is_on_curve(public_key) and is_on_curve(R)):
+        return False
+    return 0 < s < curve.n and R[0] % curve.n != 0
+
+@instrument.timed('ec_verify')
+def verify(public_key, message, signature, prehashed=False):
+    """ Verifies a signature (R, s) on a message against a public key. """
+    if not valid_signature_values(public_key, signature):
+        return False
+    R, s = signature
+    e = hash_message(message, prehashed)
+    rhs = multi_scalar_mult([(R[0] % curve.n, public_key), (s, R)])
+    return to_affine(rhs) == scalar_base_mult(e)
+
+@instrument.timed('ec_verify_batch')
+def verify_batch(items, prehashed=False):
+    """ Verifies many (message, signature, public_key) triples at once.
+
+        Each equation e_i * G - r_i * Q_i - s_i * R_i = 0 is multiplied by a
+        random z_i and the results are summed, so all of them are checked by
+        a single multi-scalar multiplication. Returns True only if every
+        signature is valid (a forged one passes with probability 2^-128).
+    """
+    g_scalar = 0
+    pairs = []
+    for message, signature, public_key in items:
+        if not valid_signature_values(public_key, signature):
+            return False
+        R, s = signature
+        z = secrets.randbits(BATCH_RANDOMIZER_BITS) | 1
+        g_scalar += z * hash_message(message, prehashed)
+        pairs.append((-z * (R[0] % curve.n), public_key))
+        pairs.append((-z * s, R))
+
+    total = jacobian_add_affine(multi_scalar_mult(pairs), scalar_base_mult(g_scalar))
+    return total is None
@@ -0,0 +1,229 @@
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from random import SystemRandom
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows; the pool file is then not locked
+    fcntl = None
+
+""" ElGamal parameter generation without sympy: sieve-prefiltered
+    Miller-Rabin search for safe primes p = 2q + 1 with a generator g of
+    the whole group, and an on-disk pool of pregenerated (p, g) pairs per
+    key length, refilled in a background thread.
+"""
+
+random = SystemRandom()
+
+# Miller-Rabin rounds for a candidate that survived the sieve and base 2
+MILLER_RABIN_ROUNDS = 30
+
+# Candidates sieved together by random_safe_prime
+SIEVE_WINDOW = 4096
+
+# Systems kept per key length, and the level below which a refill starts
+POOL_TARGET = 8
+POOL_LOW_WATERMARK = 4
+
+DEFAULT_POOL_PATH = os.environ.get(
+    'ELGAMAL_PARAMS_POOL',
+    os.path.join(os.path.expanduser('~'), '.cache', 'elgamal_params.json'))
+
+def small_primes(limit=2000):
+    """ Returns the odd primes below limit (sieve of Eratosthenes). """
+    sieve = bytearray([1]) * limit
+    sieve[:2] = b'\x00\x00'
+    for i in range(2, int(limit ** 0.5) + 1):
+        if sieve[i]:
+            sieve[i * i::i] = bytes(len(range(i * i, limit, i)))
+    return [i for i in range(3, limit) if sieve[i]]
+
+SMALL_PRIMES = small_primes()
+
+def miller_rabin(n, bases):
+    """ Returns False if one of bases proves n composite. n must be odd and > 3. """
+    neg_one = n - 1
+    s, d = 0, neg_one
+    while not d & 1:
+        s, d = s + 1, d >> 1
+
+    for a in bases:
+        x = pow(a, d, n)
+        if x in (1, neg_one):
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == neg_one:
+                break
+        else:
+            return False
+    return True
+
+def is_probable_prime(n, rounds=MILLER_RABIN_ROUNDS):
+    """ Miller-Rabin test after trial division by SMALL_PRIMES. """
+    if n < 2:
+        return False
+    for q in [2] + SMALL_PRIMES:
+        if n % q == 0:
+            return n == q
+    if not miller_rabin(n, [2]):
+        return False
+    return miller_rabin(n, [random.randrange(2, n - 1) for _ in range(rounds)])
+
+def random_safe_prime(bits):
+    """ Returns a random safe prime p = 2q + 1 (q prime) with 2^(bits-1) <= p < 2^bits.
+
+        Candidates q are sieved in windows: any q with q or 2q + 1 divisible
+        by a small prime is crossed out before Miller-Rabin is run.
+    """
+    if bits < 4:
+        raise ValueError("Key length is too small for a safe prime")
+    low, high = 1 << (bits - 2), 1 << (bits - 1)  # range of q
+    primes = [q for q in SMALL_PRIMES if q < low]
+    while True:
+        start = random.randrange(low, high) | 1
+        # window[i] stands for q = start + 2i
+        window = bytearray([1]) * SIEVE_WINDOW
+        for prime in primes:
+            inverse_two = (prime + 1) // 2
+            # First i with q == 0, then with 2q + 1 == 0 (q == -1/2), mod prime
+            for first in ((-start * inverse_two) % prime, ((-inverse_two - start) * inverse_two) % prime):
+                window[first::prime] = bytes(len(range(first, SIEVE_WINDOW, prime)))
+
+        for i in range(SIEVE_WINDOW):
+            q = start + 2 * i
+            if not window[i] or q >= high:
+                continue
+            p = 2 * q + 1
+            if miller_rabin(q, [2]) and miller_rabin(p, [2]) and is_probable_prime(q) and is_probable_prime(p):
+                return p
+
+def find_generator(p):
+    """ Returns a random generator of the multiplicative group of a safe prime p. """
+    q = (p - 1) // 2
+    while True:
+        g = random.randint(2, p - 2)
+        # g is neither 1 nor -1, so its order is q or p - 1
+        if pow(g, q, p) != 1:
+            return g
+
+def generate_parameters(key_length):
+    """ Generates a fresh (p, g) pair for a key length in bits. """
+    p = random_safe_prime(key_length)
+    return (p, find_generator(p))
+
+class ParameterPool:
+    """ Pregenerated (p, g) pairs per key length, persisted as JSON.
+
+        take() hands out each pair once. When a key length runs below
+        low_watermark the pool is topped up to target in a daemon thread, so
+        callers only wait on a prime search when the pool is empty.
+    """
+
+    def __init__(self, path=DEFAULT_POOL_PATH, target=POOL_TARGET, low_watermark=POOL_LOW_WATERMARK):
+        self.path = path
+        self.target = target
+        self.low_watermark = low_watermark
+        self.lock = threading.Lock()
+        self.refilling = set()
+        self.systems = self.load()
+
+    def load(self):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as f:
+                return {int(bits): [tuple(system) for system in systems] for bits, systems in json.load(f).items()}
+        except (OSError, ValueError):
+            return {}
+
+    @contextmanager
+    def file_lock(self):
+        # Hold an exclusive lock on path + '.lock', so pools in other
+        # processes sharing the file never hand out the same pair
+        if not self.path or fcntl is None:
+            yield
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def reload(self):
+        # Called with both locks held; another process may have changed the file
+        if self.path:
+            self.systems = self.load()
+
+    def save(self):
+        # Called with both locks held; the file is replaced atomically through
+        # a temporary file of our own
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path) or '.'
+        os.makedirs(directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(self.path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({str(bits): systems for bits, systems in self.systems.items()}, f)
+            os.replace(temp, self.path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def available(self, key_length):
+        with self.lock:
+            return len(self.systems.get(key_length, ()))
+
+    def take(self, key_length):
+        """ Returns an unused (p, g) pair, generating one only if the pool is empty. """
+        with self.lock, self.file_lock():
+            self.reload()
+            systems = self.systems.get(key_length, [])
+            system = systems.pop() if systems else None
+            if system is not None:
+                self.save()
+        if len(systems) < self.low_watermark:
+            self.start_refill(key_length)
+        return system if system is not None else generate_parameters(key_length)
+
+    def add(self, key_length, system):
+        with self.lock, self.file_lock():
+            self.reload()
+            self.systems.setdefault(key_length, []).append(tuple(system))
+            self.save()
+
+    def fill(self, key_length):
+        """ Generates pairs in the calling thread until the pool holds target. """
+        while self.available(key_length) < self.target:
+            self.add(key_length, generate_parameters(key_length))
+
+    def start_refill(self, key_length):
+        """ Runs fill() in a daemon thread unless one is already running for key_length. """
+        with self.lock:
+            if key_length in self.refilling:
+                return
+            self.refilling.add(key_length)
+
+        def refill():
+            try:
+                self.fill(key_length)
+            finally:
+                with self.lock:
+                    self.refilling.discard(key_length)
+
+        threading.Thread(target=refill, name='elgamal-params-%d' % key_length, daemon=True).start()
+
+_default_pool = None
+
+def default_pool():
+    """ Returns the process-wide pool stored at DEFAULT_POOL_PATH. """
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = ParameterPool()
+    return _default_pool
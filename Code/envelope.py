@@ -0,0 +1,173 @@
+import collections
+import functools
+import secrets
+import struct
+from ec_elgamal import sign, verify, verify_many
+from merkle_hellman_knapsack import encrypt_bytes, encrypt_many
+from hashlib import sha256
+from CFB import cfb_encrypt_hash, cfb_decrypt_hash
+
+""" Sealing and opening messages: FEAL-CFB encryption under a fresh
+    session key, the key wrapped with the recipient's Merkle-Hellman public
+    key, and the SHA-256 digest of the header and ciphertext signed with
+    the sender's ElGamal key. The digest is computed in the same pass as the
+    CFB encryption (and decryption) and is signed as is, without rehashing.
+
+    Binary envelope format (integers big-endian):
+        4 bytes   MAGIC
+        1 byte    CFB segment size in bytes
+        8 bytes   IV
+        int       wrapped session key
+        int       signature r
+        int       signature s
+        ...       ciphertext (the rest)
+    where each int is a 2-byte length followed by that many bytes. The
+    signature covers everything but itself: MAGIC, segment size, IV and
+    wrapped key, then the ciphertext.
+"""
+
+MAGIC = b'FMv3'
+
+# CFB segment size (bits) used by seal
+SEGMENT_SIZE = 64
+
+Envelope = collections.namedtuple('Envelope', 'segment_size iv wrapped_key signature ciphertext')
+
+def pack_int(value):
+    data = value.to_bytes(max(1, (value.bit_length() + 7) // 8), 'big')
+    return struct.pack('>H', len(data)) + data
+
+def unpack_int(data, offset):
+    if offset + 2 > len(data):
+        raise ValueError("Truncated envelope.")
+    (length,) = struct.unpack_from('>H', data, offset)
+    offset += 2
+    if offset + length > len(data):
+        raise ValueError("Truncated envelope.")
+    return int.from_bytes(data[offset:offset + length], 'big'), offset + length
+
+def header(segment_size, iv, wrapped_key):
+    # The signed fields ahead of the signature
+    return b''.join([MAGIC, bytes([segment_size // 8]), iv, pack_int(wrapped_key)])
+
+def header_hash(segment_size, iv, wrapped_key):
+    # A SHA-256 factory already fed the header, for cfb_*_hash to go on
+    # with the ciphertext
+    return functools.partial(sha256, header(segment_size, iv, wrapped_key))
+
+def pack(envelope):
+    """ Serializes an Envelope to bytes. """
+    r, s = envelope.signature
+    return b''.join([header(envelope.segment_size, envelope.iv, envelope.wrapped_key),
+                     pack_int(r), pack_int(s), envelope.ciphertext])
+
+def unpack(data):
+    """ Parses bytes produced by pack() into an Envelope. """
+    data = bytes(data)
+    if data[:4] != MAGIC or len(data) < 13:
+        raise ValueError("Not an envelope.")
+    if not 1 <= data[4] <= 8:
+        raise ValueError("Invalid segment size.")
+    segment_size = data[4] * 8
+    iv = data[5:13]
+    wrapped_key, offset = unpack_int(data, 13)
+    r, offset = unpack_int(data, offset)
+    s, offset = unpack_int(data, offset)
+    return Envelope(segment_size, iv, wrapped_key, (r, s), data[offset:])
+
+def sign_digest(sender_sig_key, digest):
+    # sender_sig_key is an ec_elgamal.Signer or a (system, private_key) pair
+    if hasattr(sender_sig_key, 'sign'):
+        return sender_sig_key.sign(digest, prehashed=True)
+    system, private_key = sender_sig_key
+    return sign(system, private_key, digest, prehashed=True)
+
+def wrap_key(session_key, recipient_pub):
+    # recipient_pub is a Merkle-Hellman public key or a key_cache.Correspondent
+    if hasattr(recipient_pub, 'byte_tables'):
+        return encrypt_bytes(session_key, recipient_pub.mh_public_key, recipient_pub.byte_tables)
+    return encrypt_bytes(session_key, recipient_pub)
+
+def sender_key(sender_pub):
+    # (system, public_key, public_table) of a (system, public_key) pair or a
+    # key_cache.Correspondent
+    if hasattr(sender_pub, 'public_table'):
+        return sender_pub.system, sender_pub.public_key, sender_pub.public_table
+    system, public_key = sender_pub
+    return system, public_key, None
+
+def seal_with_key(message, session_key, wrapped_key, sender_sig_key, segment_size):
+    iv = secrets.token_bytes(8)
+    ciphertext, digest = cfb_encrypt_hash(session_key, iv, message, segment_size,
+                                          hash_factory=header_hash(segment_size, iv, wrapped_key))
+    signature = sign_digest(sender_sig_key, digest)
+    return pack(Envelope(segment_size, iv, wrapped_key, signature, ciphertext))
+
+def seal(message, recipient_pub, sender_sig_key, segment_size=SEGMENT_SIZE):
+    """ Encrypts and signs a message for one recipient, returning envelope bytes.
+
+        recipient_pub is a Merkle-Hellman public key of 64 elements (or a
+        key_cache.Correspondent) and sender_sig_key an ec_elgamal.Signer or
+        a (system, private_key) pair.
+    """
+    session_key = secrets.token_bytes(8)
+    return seal_with_key(message, session_key, wrap_key(session_key, recipient_pub), sender_sig_key, segment_size)
+
+def open(envelope, recipient_key, sender_pub):
+    """ Verifies and decrypts envelope bytes, returning the message.
+
+        recipient_key is a merkle_hellman_knapsack.PrivateKey and sender_pub
+        a (system, public_key) pair or a key_cache.Correspondent. Raises
+        ValueError if the envelope is malformed or the signature is invalid.
+    """
+    envelope = unpack(envelope)
+    system, public_key, public_table = sender_key(sender_pub)
+    message, digest = decrypt_hash(envelope, recipient_key.decrypt_bytes(envelope.wrapped_key))
+    if not verify(system, public_key, digest, envelope.signature, prehashed=True, public_table=public_table):
+        raise ValueError("Invalid signature.")
+    return message
+
+def decrypt_hash(envelope, session_key):
+    # Decrypt and hash the header and ciphertext in one pass; the plaintext
+    # is only released once the signature on the digest checks out
+    return cfb_decrypt_hash(session_key, envelope.iv, envelope.ciphertext, envelope.segment_size,
+                            hash_factory=header_hash(envelope.segment_size, envelope.iv, envelope.wrapped_key))
+
+def seal_many(messages, recipient_pub, sender_sig_key, segment_size=SEGMENT_SIZE):
+    """ Seals a batch of messages for one recipient. The recipient's
+        subset-sum tables are built once and every session key is wrapped
+        in one pass.
+    """
+    messages = list(messages)
+    session_keys = [secrets.token_bytes(8) for _ in messages]
+    if hasattr(recipient_pub, 'byte_tables'):
+        wrapped_keys = [wrap_key(session_key, recipient_pub) for session_key in session_keys]
+    else:
+        wrapped_keys = [row[0] for row in encrypt_many(session_keys, [recipient_pub])]
+    return [seal_with_key(message, session_key, wrapped_key, sender_sig_key, segment_size)
+            for message, session_key, wrapped_key in zip(messages, session_keys, wrapped_keys)]
+
+def open_many(envelopes, recipient_key, sender_pub):
+    """ Opens a batch of envelopes from one sender, verifying all signatures
+        against the sender's system with shared tables. Returns one result
+        per envelope, in order: the message, or the ValueError of an
+        envelope that is malformed or whose signature is invalid, so one bad
+        envelope does not hold back the others.
+    """
+    results = []
+    unpacked = []
+    for data in envelopes:
+        try:
+            unpacked.append((len(results), unpack(data)))
+            results.append(None)
+        except ValueError as error:
+            results.append(error)
+    system, public_key, public_table = sender_key(sender_pub)
+    session_keys = recipient_key.decrypt_many([envelope.wrapped_key for _, envelope in unpacked])
+    opened = [decrypt_hash(envelope, session_key) for session_key, (_, envelope) in zip(session_keys, unpacked)]
+    valid = verify_many(system, [(public_key, digest, envelope.signature)
+                                 for (_, digest), (_, envelope) in zip(opened, unpacked)],
+                        prehashed=True, public_table=public_table)
+    for (index, _), (message, _), ok in zip(unpacked, opened, valid):
+        results[index] = message if ok else ValueError("Invalid signature.")
+    return results
@@ -1,4 +1,10 @@
+from functools import lru_cache
 from utils import *
+import feal_numpy
+import instrument
+
+# Number of expanded key schedules kept by get_cipher
+CIPHER_CACHE_SIZE = 1024
 
 def key_generation(key, rounds=4):
     # https://link.springer.com/content/pdf/10.1007/3-540-38424-3_46.pdf
@@ -61,6 +67,61 @@ def split(L_R):
     # """
     return (L_R[:4], L_R[4:])
 
+def subkey_words(subkey):
+    # """
+    # Pack the subkeys from key_generation into 32-bit words.
+    #
+    # Args:
+    #     subkey (list): The subkeys generated for encryption.
+    #
+    # Returns:
+    #     list: The round keys followed by the two whitening words
+    #           (subkey[-8:-4] and subkey[-4:]), one int per 4 bytes.
+    # """
+    return [int.from_bytes(bytes(subkey[i:i + 4]), 'big') for i in range(0, len(subkey), 4)]
+
+def encrypt_word(block, words, N=4):
+    # """
+    # Encrypt one block held as a 64-bit int (L in the top half).
+    #
+    # Args:
+    #     block (int): The block to be encrypted.
+    #     words (list): The subkeys packed by subkey_words.
+    #     N (int): The number of rounds for the encryption process.
+    #
+    # Returns:
+    #     int: The encrypted block.
+    # """
+    L = (block >> 32) ^ words[-2]
+    R = (block & 0xffffffff) ^ words[-1] ^ L
+
+    for i in range(N):
+        L ^= F1_word(R ^ words[i])
+        L, R = R, L
+
+    return (R << 32) | (R ^ L)
+
+def decrypt_word(block, words, N=4):
+    # """
+    # Decrypt one block held as a 64-bit int (L in the top half).
+    #
+    # Args:
+    #     block (int): The block to be decrypted.
+    #     words (list): The subkeys packed by subkey_words.
+    #     N (int): The number of rounds for the decryption process.
+    #
+    # Returns:
+    #     int: The decrypted block.
+    # """
+    R = block >> 32
+    L = (block & 0xffffffff) ^ R
+
+    for i in reversed(range(N)):
+        L, R = R, L
+        L ^= F1_word(words[i] ^ R)
+
+    return ((L ^ words[-2]) << 32) | (R ^ L ^ words[-1])
+
 def encrypt(data, subkey, N=4):
     # """
     # Encrypt the data using FEAL-4 encryption algorithm.
@@ -73,6 +134,52 @@ def encrypt(data, subkey, N=4):
     # Returns:
     #     bytes: The encrypted data.
     # """
+    data = pad(data)
+    if instrument.enabled:
+        instrument.count('feal.blocks', len(data) // 8)
+    if feal_numpy.AVAILABLE and len(data) >= feal_numpy.NUMPY_THRESHOLD * 8:
+        return feal_numpy.encrypt(data, subkey, N)
+
+    words = subkey_words(subkey)
+    result = bytearray(len(data))
+
+    for k in range(0, len(data), 8):
+        block = encrypt_word(int.from_bytes(data[k:k + 8], 'big'), words, N)
+        result[k:k + 8] = block.to_bytes(8, 'big')
+
+    return bytes(result)
+
+def decrypt(data, subkey, N=4):
+    #"""
+    # Decrypt the data using FEAL-4 encryption algorithm.
+    
+    # Args:
+    #     data (bytes): The data to be decrypted.
+    #     subkey (list): The subkeys generated for decryption.
+    #     N (int): The number of rounds for the decryption process.
+        
+    # Returns:
+    #     bytes: The decrypted data.
+    # """
+    if instrument.enabled:
+        instrument.count('feal.blocks', len(data) // 8)
+    if feal_numpy.AVAILABLE and len(data) >= feal_numpy.NUMPY_THRESHOLD * 8:
+        return feal_numpy.decrypt(data[:len(data) // 8 * 8], subkey, N).strip(b'\x00')
+
+    words = subkey_words(subkey)
+    result = bytearray(len(data) // 8 * 8)
+
+    for k in range(0, len(result), 8):
+        block = decrypt_word(int.from_bytes(data[k:k + 8], 'big'), words, N)
+        result[k:k + 8] = block.to_bytes(8, 'big')
+
+    return bytes(result).strip(b'\x00')
+
+def encrypt_reference(data, subkey, N=4):
+    # """
+    # Reference FEAL-4 encryption on lists of bytes, computing F1 through the
+    # S-box functions. Kept to check the word-based encrypt() against.
+    # """
     result = []
     data = pad(data)
 
@@ -93,26 +200,19 @@ def encrypt(data, subkey, N=4):
 
     return bytes(result)
 
-def decrypt(data, subkey, N=4):
-    #"""
-    # Decrypt the data using FEAL-4 encryption algorithm.
-    
-    # Args:
-    #     data (bytes): The data to be decrypted.
-    #     subkey (list): The subkeys generated for decryption.
-    #     N (int): The number of rounds for the decryption process.
-        
-    # Returns:
-    #     bytes: The decrypted data.
+def decrypt_reference(data, subkey, N=4):
+    # """
+    # Reference FEAL-4 decryption on lists of bytes, computing F1 through the
+    # S-box functions. Kept to check the word-based decrypt() against.
     # """
     result = []
-    
+
     for k in range(len(data) // 8):
         bloc = data[k * 8:(k + 1) * 8]
         L, R = split(bloc)
         R = xor(L, R)
         L, R = R, L
-        
+
         for i in reversed(range(N)):
             L, R = R, L
             L = xor(L, F1(xor(subkey[i * 4:(i + 1) * 4], R)))
@@ -124,3 +224,111 @@ def decrypt(data, subkey, N=4):
 
     return bytes(result).strip(b'\x00')
 
+class FealCipher:
+    # """
+    # FEAL-4 cipher with the key schedule expanded once into 32-bit words.
+    #
+    # Args:
+    #     key (bytes): The 64-bit key.
+    #     N (int): The number of rounds for the encryption process.
+    # """
+    block_size = 8
+
+    def __init__(self, key, N=4):
+        self.key = bytes(key)
+        self.N = N
+        self.subkey = key_generation(self.key)
+        self.words = subkey_words(self.subkey)
+        self.round_words = tuple(self.words[:N])
+        self.K_L, self.K_R = self.words[-2], self.words[-1]
+
+    def encrypt_word(self, block):
+        # """ Encrypt one block held as a 64-bit int, same as encrypt_word(block, words). """
+        F = F1_word
+        L = (block >> 32) ^ self.K_L
+        R = (block & 0xffffffff) ^ self.K_R ^ L
+
+        for w in self.round_words:
+            L ^= F(R ^ w)
+            L, R = R, L
+
+        return (R << 32) | (R ^ L)
+
+    def decrypt_word(self, block):
+        # """ Decrypt one block held as a 64-bit int, same as decrypt_word(block, words). """
+        F = F1_word
+        R = block >> 32
+        L = (block & 0xffffffff) ^ R
+
+        for w in reversed(self.round_words):
+            L, R = R, L
+            L ^= F(w ^ R)
+
+        return ((L ^ self.K_L) << 32) | (R ^ L ^ self.K_R)
+
+    def encrypt_block(self, block):
+        # """ Encrypt exactly one 8-byte block. """
+        return self.encrypt_word(int.from_bytes(block, 'big')).to_bytes(8, 'big')
+
+    def decrypt_block(self, block):
+        # """ Decrypt exactly one 8-byte block. """
+        return self.decrypt_word(int.from_bytes(block, 'big')).to_bytes(8, 'big')
+
+    def encrypt_words(self, blocks):
+        # """ Encrypt an iterable of 64-bit block ints, returning a list. """
+        encrypt_word = self.encrypt_word
+        return [encrypt_word(block) for block in blocks]
+
+    def decrypt_words(self, blocks):
+        # """ Decrypt an iterable of 64-bit block ints, returning a list. """
+        decrypt_word = self.decrypt_word
+        return [decrypt_word(block) for block in blocks]
+
+    def encrypt(self, data):
+        # """ Encrypt the data, same output as encrypt(data, subkey). """
+        data = pad(data)
+        if instrument.enabled:
+            instrument.count('feal.blocks', len(data) // 8)
+        if feal_numpy.AVAILABLE and len(data) >= feal_numpy.NUMPY_THRESHOLD * 8:
+            return feal_numpy.encrypt(data, self.subkey, self.N)
+
+        encrypt_word = self.encrypt_word
+        result = bytearray(len(data))
+
+        for k in range(0, len(data), 8):
+            result[k:k + 8] = encrypt_word(int.from_bytes(data[k:k + 8], 'big')).to_bytes(8, 'big')
+
+        return bytes(result)
+
+    def decrypt(self, data):
+        # """ Decrypt the data, same output as decrypt(data, subkey). """
+        if instrument.enabled:
+            instrument.count('feal.blocks', len(data) // 8)
+        if feal_numpy.AVAILABLE and len(data) >= feal_numpy.NUMPY_THRESHOLD * 8:
+            return feal_numpy.decrypt(data[:len(data) // 8 * 8], self.subkey, self.N).strip(b'\x00')
+
+        decrypt_word = self.decrypt_word
+        result = bytearray(len(data) // 8 * 8)
+
+        for k in range(0, len(result), 8):
+            result[k:k + 8] = decrypt_word(int.from_bytes(data[k:k + 8], 'big')).to_bytes(8, 'big')
+
+        return bytes(result).strip(b'\x00')
+
+@lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def _cached_cipher(key, N):
+    return FealCipher(key, N)
+
+def get_cipher(key, N=4):
+    # """
+    # Return the FealCipher for key, expanding the key schedule only the first
+    # time a key is seen. The last CIPHER_CACHE_SIZE keys are kept.
+    #
+    # Args:
+    #     key (bytes): The 64-bit key.
+    #     N (int): The number of rounds for the encryption process.
+    #
+    # Returns:
+    #     FealCipher: The cipher for key.
+    # """
+    return _cached_cipher(bytes(key), N)
@@ -0,0 +1,303 @@
+import argparse
+import functools
+import json
+import mmap
+import os
+import secrets
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from hashlib import sha256
+import backends
+from CFB import cfb_encrypt, cfb_encrypt_hash, cfb_decrypt_hash
+from ec_elgamal import generate_system, generate_keys, sign, verify
+from merkle_hellman_knapsack import PrivateKey, encrypt_bytes, generate_key_pair
+
+""" Encrypting files and directory trees in place. Each file is memory-mapped
+    and FEAL-CFB runs over the mapping itself under a fresh session key and
+    IV, hashing the ciphertext in the same pass. The session key is wrapped
+    with the Merkle-Hellman public key, and the digest of the file's
+    manifest entry and ciphertext signed with the ElGamal key, as in
+    envelope.seal, but the IV, wrapped key and signature go to a JSON
+    manifest instead of the file, so file sizes do not change. Files are spread over a process pool, largest first.
+
+    The keys of every file are written to a journal next to the manifest
+    before any file is modified, and each signature as its file completes;
+    the manifest is then built from the journal. If a run is interrupted,
+    recover_manifest turns the journal it left into a manifest.
+
+    Keep the manifest: without it the files cannot be decrypted.
+"""
+
+# CFB segment size (bits) used for files
+SEGMENT_SIZE = 64
+
+# Key length (bits) of the ElGamal system made by keygen
+KEY_LENGTH = 128
+
+MANIFEST_VERSION = 2
+
+# Manifest entry fields covered by the signature, with the file's path
+SIGNED_FIELDS = ('size', 'segment_size', 'iv', 'wrapped_key')
+
+Keys = namedtuple('Keys', 'recipient_pub recipient_key sender_sig_key sender_pub')
+
+def generate_key_file(path, key_length=KEY_LENGTH):
+    """ Writes a new key file holding a Merkle-Hellman key pair and an
+        ElGamal signing key, readable by the owner only.
+    """
+    recipient_key, recipient_pub = generate_key_pair(64)
+    system = generate_system(key_length, sha256())
+    private_key, public_key = generate_keys(system)
+    keys = {'mh_private_key': {'sequence': recipient_key.sequence, 'q': recipient_key.q, 'r': recipient_key.r},
+            'mh_public_key': recipient_pub,
+            'elgamal_system': list(system),
+            'elgamal_private_key': private_key,
+            'elgamal_public_key': public_key}
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(keys, f)
+
+def load_keys(path):
+    """ Reads a key file written by generate_key_file. """
+    with open(path) as f:
+        keys = json.load(f)
+    mh = keys['mh_private_key']
+    system = tuple(keys['elgamal_system'])
+    return Keys(keys['mh_public_key'], PrivateKey(mh['sequence'], mh['q'], mh['r']),
+                (system, keys['elgamal_private_key']), (system, keys['elgamal_public_key']))
+
+@contextmanager
+def mapped(path):
+    # Map path read-write, so changes to the buffer go straight to the file
+    with open(path, 'r+b') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield bytearray()  # mmap cannot map an empty file
+            return
+        with mmap.mmap(f.fileno(), 0) as data:
+            yield data
+            data.flush()
+
+def entry_hash(name, entry):
+    # A SHA-256 factory already fed the path and signed fields of a manifest
+    # entry, for cfb_*_hash to go on with the ciphertext
+    header = json.dumps([name] + [entry[field] for field in SIGNED_FIELDS]).encode()
+    return functools.partial(sha256, header)
+
+def encrypt_path(path, name, entry, session_key, sender_sig_key):
+    # Worker: encrypt one file in place under the journaled key and IV and
+    # return the signature of its entry and ciphertext
+    iv = bytes.fromhex(entry['iv'])
+    with mapped(path) as data:
+        if len(data) != entry['size']:
+            raise ValueError("File size changed before encryption.")
+        _, digest = cfb_encrypt_hash(session_key, iv, data, entry['segment_size'], out=data,
+                                     hash_factory=entry_hash(name, entry))
+    system, private_key = sender_sig_key
+    return list(sign(system, private_key, digest, prehashed=True))
+
+def decrypt_path(path, name, entry, recipient_key, sender_pub):
+    # Worker: decrypt one file in place if its signature is valid. Decryption
+    # and hashing share one pass, so on a bad signature the file is put back
+    # by encrypting again under the same key, IV and segment size.
+    session_key = recipient_key.decrypt_bytes(entry['wrapped_key'])
+    iv = bytes.fromhex(entry['iv'])
+    segment_size = entry['segment_size']
+    system, public_key = sender_pub
+    with mapped(path) as data:
+        if len(data) != entry['size']:
+            raise ValueError("File size does not match the manifest.")
+        _, digest = cfb_decrypt_hash(session_key, iv, data, segment_size, out=data,
+                                     hash_factory=entry_hash(name, entry))
+        if not verify(system, public_key, digest, tuple(entry['signature']), prehashed=True):
+            cfb_encrypt(session_key, iv, data, segment_size, out=data)
+            raise ValueError("Invalid signature.")
+    return entry['size']
+
+def collect_files(paths, exclude=()):
+    """ Expands files and directory trees into a sorted list of regular
+        files, skipping symbolic links and the paths in exclude.
+    """
+    exclude = {os.path.realpath(path) for path in exclude}
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names)
+        else:
+            files.append(path)
+    return sorted({os.path.realpath(path) for path in files
+                   if os.path.isfile(path) and not os.path.islink(path)} - exclude)
+
+def run_jobs(function, jobs, workers, done=None):
+    # Run function(*args) for each (name, args) in jobs, in a pool of
+    # workers processes (in-process for one worker), calling done(name,
+    # result) as each job succeeds. Returns {name: result} and
+    # {name: exception} for the jobs that failed.
+    results, errors = {}, {}
+    if workers <= 1:
+        for name, args in jobs:
+            try:
+                results[name] = function(*args)
+            except Exception as error:
+                errors[name] = error
+            else:
+                if done:
+                    done(name, results[name])
+        return results, errors
+
+    with ProcessPoolExecutor(workers) as pool:
+        futures = {pool.submit(function, *args): name for name, args in jobs}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                results[name] = future.result()
+            except Exception as error:
+                errors[name] = error
+            else:
+                if done:
+                    done(name, results[name])
+    return results, errors
+
+def journal_path(manifest_path):
+    return manifest_path + '.journal'
+
+def append_journal(f, records):
+    # One JSON object per line, on disk before the caller goes on
+    f.write(''.join(json.dumps(record) + '\n' for record in records))
+    f.flush()
+    os.fsync(f.fileno())
+
+def read_journal(path):
+    # Merge the records of each file into one manifest entry
+    entries = {}
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break  # The last line was cut short by a crash
+            entries.setdefault(record.pop('file'), {}).update(record)
+    return entries
+
+def write_manifest(path, entries):
+    # Signed entries go under 'files'. Files that did not finish keep their
+    # keys under 'unsigned', so they can still be recovered by hand. The
+    # manifest is replaced atomically.
+    files = {name: entry for name, entry in entries.items() if 'signature' in entry}
+    unsigned = {name: entry for name, entry in entries.items() if 'signature' not in entry}
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files, 'unsigned': unsigned}, f, indent=1, sort_keys=True)
+    os.replace(temp, path)
+    return sorted(unsigned)
+
+def encrypt_files(paths, manifest_path, keys, workers=None, segment_size=SEGMENT_SIZE, exclude=()):
+    """ Encrypts files and directory trees in place, writing a manifest with
+        paths relative to its own directory. The manifest and the paths in
+        exclude (such as the key file) are never encrypted, and an existing
+        manifest is never overwritten. Returns the exceptions of the files
+        that failed, by path; the others are in the manifest.
+    """
+    if os.path.exists(manifest_path):
+        raise FileExistsError("Manifest %s already exists." % manifest_path)
+    journal = journal_path(manifest_path)
+    if os.path.exists(journal):
+        raise FileExistsError("Journal %s of an interrupted run exists; recover it first." % journal)
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    files = collect_files(paths, exclude=[manifest_path, journal, *exclude])
+    files.sort(key=os.path.getsize, reverse=True)  # Largest first keeps the pool busy to the end
+
+    # Creating the journal also checks the manifest directory is writable
+    # before any file is touched
+    with open(journal, 'x') as f:
+        records, jobs = [], []
+        for path in files:
+            session_key, name = secrets.token_bytes(8), os.path.relpath(path, base)
+            entry = {'size': os.path.getsize(path), 'segment_size': segment_size, 'iv': secrets.token_hex(8),
+                     'wrapped_key': encrypt_bytes(session_key, keys.recipient_pub)}
+            records.append(dict(entry, file=name))
+            jobs.append((path, (path, name, entry, session_key, keys.sender_sig_key)))
+        append_journal(f, records)
+
+        def done(path, signature):
+            append_journal(f, [{'file': os.path.relpath(path, base), 'signature': signature}])
+
+        _, errors = run_jobs(encrypt_path, jobs, workers or os.cpu_count() or 1, done)
+    write_manifest(manifest_path, read_journal(journal))
+    os.remove(journal)
+    return errors
+
+def recover_manifest(manifest_path):
+    """ Writes the manifest of an interrupted encrypt_files from the journal
+        it left. Returns the files that never got a signature; their keys
+        are kept under 'unsigned' but decrypt_files skips them.
+    """
+    if os.path.exists(manifest_path):
+        raise FileExistsError("Manifest %s already exists." % manifest_path)
+    journal = journal_path(manifest_path)
+    unsigned = write_manifest(manifest_path, read_journal(journal))
+    os.remove(journal)
+    return unsigned
+
+def decrypt_files(manifest_path, keys, workers=None):
+    """ Decrypts in place every file listed in a manifest whose signature is
+        valid. Returns the exceptions of the files that failed, by path.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError("Unsupported manifest version.")
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    entries = sorted(manifest['files'].items(), key=lambda item: item[1]['size'], reverse=True)
+    jobs = [(name, (os.path.join(base, name), name, entry, keys.recipient_key, keys.sender_pub))
+            for name, entry in entries]
+    _, errors = run_jobs(decrypt_path, jobs, workers or os.cpu_count() or 1)
+    return errors
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Encrypt or decrypt files and directory trees in place.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    keygen = commands.add_parser('keygen', help="write a new key file")
+    keygen.add_argument('keys')
+    encrypt = commands.add_parser('encrypt', help="encrypt files in place and write a manifest")
+    encrypt.add_argument('paths', nargs='+')
+    encrypt.add_argument('--segment-size', type=int, default=SEGMENT_SIZE, help="CFB segment size in bits")
+    decrypt = commands.add_parser('decrypt', help="decrypt the files listed in a manifest")
+    recover = commands.add_parser('recover', help="write the manifest of an interrupted encrypt from its journal")
+    recover.add_argument('--manifest', required=True)
+    for command in (encrypt, decrypt):
+        command.add_argument('--keys', required=True)
+        command.add_argument('--manifest', required=True)
+        command.add_argument('--workers', type=int, default=None, help="processes to use (default: all CPUs)")
+    args = parser.parse_args()
+    backends.apply()  # Dispatch thresholds from the cached calibration, if any
+
+    if args.command == 'keygen':
+        generate_key_file(args.keys)
+        sys.exit()
+
+    if args.command == 'recover':
+        try:
+            unsigned = recover_manifest(args.manifest)
+        except (OSError, ValueError) as error:
+            sys.exit(f"recover: {error}")
+        for name in unsigned:
+            print(f"{name}: not signed, may be partly encrypted", file=sys.stderr)
+        sys.exit(1 if unsigned else 0)
+
+    keys = load_keys(args.keys)
+    start = time.perf_counter()
+    try:
+        if args.command == 'encrypt':
+            errors = encrypt_files(args.paths, args.manifest, keys, args.workers, args.segment_size, [args.keys])
+        else:
+            errors = decrypt_files(args.manifest, keys, args.workers)
+    except (OSError, ValueError) as error:
+        sys.exit(f"{args.command}: {error}")
+    for path, error in errors.items():
+        print(f"{path}: {error}", file=sys.stderr)
+    print(f"{args.command}ed in {time.perf_counter() - start:.2f} s, {len(errors)} failed", file=sys.stderr)
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,151 @@
+import collections
+import cProfile
+import functools
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+
+""" Opt-in instrumentation for the crypto modules.
+
+    While disabled (the default) every hook is a single flag test. After
+    enable(), counters (FEAL blocks, CFB segments, point operations,
+    modular exponentiations and inversions) and per-operation latency
+    histograms are collected and returned by stats(). capture_next() makes
+    the next call of one operation run under cProfile and/or tracemalloc.
+"""
+
+enabled = False
+
+lock = threading.Lock()
+counters = collections.Counter()
+histograms = {}
+pending_captures = {}
+captures = {}
+
+# Profile lines kept in a capture report
+CAPTURE_LINES = 25
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    """ Clears all counters, histograms and captures. """
+    with lock:
+        counters.clear()
+        histograms.clear()
+        pending_captures.clear()
+        captures.clear()
+
+def count(name, n=1):
+    """ Adds n to counter name. Callers test `instrument.enabled` first on hot paths. """
+    if enabled:
+        with lock:
+            counters[name] += n
+
+class Histogram:
+    """ Latencies in power-of-two microsecond buckets. """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = collections.Counter()
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.buckets[int(seconds * 1e6).bit_length()] += 1
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total_s': self.total,
+            'mean_us': self.total / self.count * 1e6,
+            'min_us': self.min * 1e6,
+            'max_us': self.max * 1e6,
+            # bucket k holds latencies below 2^k microseconds
+            'buckets_us': {'<%d' % (1 << k): n for k, n in sorted(self.buckets.items())},
+        }
+
+def record(name, seconds):
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(seconds)
+
+def stats():
+    """ Returns {'counters': {...}, 'latency': {operation: summary}, 'captures': {...}}. """
+    with lock:
+        return {
+            'counters': dict(counters),
+            'latency': {name: histogram.summary() for name, histogram in histograms.items()},
+            'captures': dict(captures),
+        }
+
+def profile_call(function, *args, profile=True, memory=False, **kwargs):
+    """ Calls function under cProfile and/or tracemalloc and returns (result, report). """
+    profiler = cProfile.Profile() if profile else None
+    tracing = memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    if memory:
+        before = tracemalloc.take_snapshot()
+    try:
+        if profiler:
+            result = profiler.runcall(function, *args, **kwargs)
+        else:
+            result = function(*args, **kwargs)
+    finally:
+        report = {}
+        if profiler:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(CAPTURE_LINES)
+            report['profile'] = out.getvalue()
+        if memory:
+            after = tracemalloc.take_snapshot()
+            report['memory_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            report['memory'] = [str(stat) for stat in after.compare_to(before, 'lineno')[:CAPTURE_LINES]]
+            if tracing:
+                tracemalloc.stop()
+    return result, report
+
+def capture_next(name, profile=True, memory=False):
+    """ Profiles the next call of operation name; the report appears in stats()['captures']. """
+    with lock:
+        pending_captures[name] = (profile, memory)
+
+def timed(name):
+    """ Decorator recording the latency of each call under name while enabled. """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            if name in pending_captures:
+                with lock:
+                    options = pending_captures.pop(name, None)
+                if options:
+                    start = time.perf_counter()
+                    result, report = profile_call(function, *args, profile=options[0], memory=options[1], **kwargs)
+                    record(name, time.perf_counter() - start)
+                    with lock:
+                        captures[name] = report
+                    return result
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
@@ -0,0 +1,124 @@
+import collections
+import threading
+import time
+from hashlib import sha256
+from ec_elgamal import verify, public_key_table
+from merkle_hellman_knapsack import byte_tables
+from envelope import pack_int, sign_digest
+
+""" Cache of verified correspondent keys. Alice and Bob sign their
+    Merkle-Hellman public keys with their ElGamal keys; a correspondent is
+    the signed public key together with the ElGamal key that signed it.
+    Checking the signature once and keeping what every later message needs
+    (the subset-sum tables of the Merkle-Hellman key, the fixed-base table
+    of the ElGamal key) saves a verify and a rebuild per message. Entries
+    are keyed by a fingerprint of the key, signer and signature, evicted
+    least recently used first, and expire after a TTL so a revoked key is
+    not trusted forever.
+"""
+
+# Correspondents kept by a VerifiedKeyCache
+KEY_CACHE_SIZE = 4096
+
+# Seconds a verified correspondent stays trusted without checking again
+KEY_CACHE_TTL = 24 * 60 * 60
+
+Correspondent = collections.namedtuple(
+    'Correspondent', 'fingerprint mh_public_key byte_tables system public_key public_table')
+
+def public_key_digest(mh_public_key):
+    """ Returns the SHA-256 digest signed to certify a Merkle-Hellman public key. """
+    return sha256(b''.join(pack_int(element) for element in mh_public_key)).digest()
+
+def certify(mh_public_key, sender_sig_key):
+    """ Signs a Merkle-Hellman public key with an ec_elgamal.Signer or a
+        (system, private_key) pair, returning the signature.
+    """
+    return sign_digest(sender_sig_key, public_key_digest(mh_public_key))
+
+def fingerprint(mh_public_key, signature, sender_pub):
+    """ Identifies a signed public key together with its signer. """
+    # The decimal form of a tuple of ints is unambiguous and quicker to
+    # build than public_key_digest, which keeps hits cheap
+    (p, g), public_key = sender_pub
+    values = (*mh_public_key, p, g, public_key, *signature)
+    return sha256(repr(values).encode()).hexdigest()
+
+class VerifiedKeyCache:
+    """ Bounded LRU cache of verified correspondents with a TTL.
+
+        get() returns the Correspondent for a Merkle-Hellman public key, its
+        signature and the signer's (system, public_key), verifying the
+        signature and building the tables only on a miss. A key whose
+        signature does not verify raises ValueError and is not cached.
+        Safe to share between threads.
+    """
+
+    def __init__(self, max_size=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()  # fingerprint -> (expiry time, Correspondent)
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def get(self, mh_public_key, signature, sender_pub):
+        key = fingerprint(mh_public_key, signature, sender_pub)
+        with self.lock:
+            item = self.entries.get(key)
+            if item is not None:
+                expires, entry = item
+                if self.clock() < expires:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry
+                del self.entries[key]
+                self.expirations += 1
+            self.misses += 1
+
+        # Verify and build outside the lock; two threads missing on the same
+        # key at once both do the work and store the same entry
+        system, public_key = sender_pub
+        if not verify(system, public_key, public_key_digest(mh_public_key), tuple(signature), prehashed=True):
+            raise ValueError("Invalid public key signature.")
+        entry = Correspondent(key, tuple(mh_public_key), byte_tables(mh_public_key),
+                              system, public_key, public_key_table(system, public_key))
+
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, entry)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.expire()
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return entry
+
+    def expire(self):
+        # Called with the lock held; drops every expired entry
+        now = self.clock()
+        for key in [key for key, (expires, _) in self.entries.items() if expires <= now]:
+            del self.entries[key]
+            self.expirations += 1
+
+    def stats(self):
+        """ Returns hits, misses, evictions, expirations, size and hit rate. """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations, 'size': len(self.entries),
+                    'hit_rate': self.hits / lookups if lookups else 0.0}
+
+    def clear(self):
+        """ Drops every entry, e.g. after a key is revoked. Statistics are kept. """
+        with self.lock:
+            self.entries.clear()
+
+_default_cache = None
+
+def default_cache():
+    """ Returns the process-wide cache, created on first use. """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = VerifiedKeyCache()
+    return _default_cache
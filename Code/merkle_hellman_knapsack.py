@@ -1,4 +1,8 @@
+import math
 import random
+from functools import lru_cache
+from modular import inverse
+import instrument
     
 # Function to generate a super-increasing sequence for the private key
     # """
@@ -6,15 +10,18 @@ import random
     
     # Args:
     #     n (int): The length of the sequence.
+    #     rng (random.Random): Source of randomness; the module's by default.
         
     # Returns:
     #     list: A super-increasing sequence of length n.
     # """
-def generate_private_key(n):
-	sequence = [random.randint(1, 100)]
+def generate_private_key(n, rng=random):
+	sequence = [rng.randint(1, 100)]
+	total = sequence[0]  # running sum, so each step is O(1)
 	while len(sequence) < n:
-		next_element = sum(sequence) + random.randint(1, 10)
+		next_element = total + rng.randint(1, 10)
 		sequence.append(next_element)
+		total += next_element
 	return sequence
 
 # Function to generate the public key from the private key, modulus q, and multiplier r
@@ -47,6 +54,7 @@ def generate_public_key(private_key, q, r):
     # Raises:
     #     ValueError: If the length of plaintext does not match the length of the public key.
     # """
+@instrument.timed('mh_encrypt')
 def encrypt(plaintext, public_key):
     if len(plaintext) != len(public_key):
         raise ValueError("The length of plaintext must match the length of the public key.")
@@ -67,6 +75,7 @@ def encrypt(plaintext, public_key):
     # Returns:
     #     str: The decrypted binary string representing the original plaintext.
     # """
+@instrument.timed('mh_decrypt')
 def decrypt(ciphertext, private_key, q, r):
     r_inverse = pow(r, -1, q) # Modular multiplicative inverse of r
     decrypted_message = ''
@@ -92,9 +101,7 @@ def decrypt(ciphertext, private_key, q, r):
     #     int: The greatest common divisor of a and b.
     # """
 def gcd(a, b):
-    while b != 0:
-        a, b = b, a % b
-    return a
+    return math.gcd(a, b)
 
 # Function to generate a modulus and multiplier for the public key generation
     # """
@@ -102,21 +109,159 @@ def gcd(a, b):
     
     # Args:
     #     superincreasing_sequence (list): The super-increasing sequence (private key).
+    #     rng (random.Random): Source of randomness; the module's by default.
         
     # Returns:
     #     tuple: A tuple containing the modulus (q) and multiplier (r).
     # """
-def generate_modulus_multiplier(superincreasing_sequence):
+def generate_modulus_multiplier(superincreasing_sequence, rng=random):
     # Calculate the sum of elements in the superincreasing sequence
     total_sum = sum(superincreasing_sequence)
     
     # Choose a modulus larger than the sum
-    m = random.randint(total_sum + 1, total_sum * 10)
+    m = rng.randint(total_sum + 1, total_sum * 10)
     
     # Choose a multiplier coprime to the modulus
     while True:
-        r = random.randint(2, m - 1)  # Ensure r is within [2, m-1]
-        if gcd(r, m) == 1:  # Check if r and m are coprime
+        r = rng.randint(2, m - 1)  # Ensure r is within [2, m-1]
+        if math.gcd(r, m) == 1:  # Check if r and m are coprime
             break
     
-    return m, r
\ No newline at end of file
+    return m, r
+
+# Function to generate a complete key pair
+    # """
+    # Generate a private key object and its public key in one step.
+    
+    # Args:
+    #     n (int): The number of elements, e.g. 64, 128, 256 or 512.
+    #     seed (int): If given, the keys are derived deterministically from it
+    #                 (for reproducible fixtures, not for real keys).
+        
+    # Returns:
+    #     tuple: The PrivateKey and the public key.
+    # """
+def generate_key_pair(n, seed=None):
+    rng = random if seed is None else random.Random(seed)
+    sequence = generate_private_key(n, rng)
+    q, r = generate_modulus_multiplier(sequence, rng)
+    return PrivateKey(sequence, q, r), generate_public_key(sequence, q, r)
+
+
+# Function to precompute the subset sums of a public key for every byte value
+    # """
+    # Precompute one 256-entry table per byte position of the plaintext.
+    # Entry v of table j is the sum of the public key elements selected by the
+    # bits of v (most significant bit first), so encrypting a key takes one
+    # lookup and one addition per byte.
+    
+    # Args:
+    #     public_key (list): The public key; its length must be a multiple of 8.
+        
+    # Returns:
+    #     tuple: len(public_key) // 8 tables of 256 sums.
+    # """
+def byte_tables(public_key):
+    if len(public_key) % 8 != 0:
+        raise ValueError("The length of the public key must be a multiple of 8.")
+    tables = []
+    for j in range(0, len(public_key), 8):
+        weights = public_key[j:j + 8]
+        table = [0] * 256
+        for value in range(1, 256):
+            # Add the weight of the lowest set bit to the sum without it
+            lowest = (value & -value).bit_length() - 1
+            table[value] = table[value & (value - 1)] + weights[7 - lowest]
+        tables.append(tuple(table))
+    return tuple(tables)
+
+@lru_cache(maxsize=1024)
+def cached_byte_tables(public_key):
+    return byte_tables(public_key)
+
+# Function to encrypt raw bytes using the public key
+    # """
+    # Encrypt raw bytes, same result as encrypt() on their binary string.
+    
+    # Args:
+    #     plaintext (bytes): The bytes to encrypt, e.g. a FEAL key.
+    #     public_key (list): The public key (its tables are cached).
+    #     tables (tuple): Its byte_tables(), if already at hand.
+        
+    # Returns:
+    #     int: The encrypted message as an integer.
+        
+    # Raises:
+    #     ValueError: If the bit length of plaintext does not match the length of the public key.
+    # """
+@instrument.timed('mh_encrypt')
+def encrypt_bytes(plaintext, public_key, tables=None):
+    if len(plaintext) * 8 != len(public_key):
+        raise ValueError("The length of plaintext must match the length of the public key.")
+    if tables is None:
+        tables = cached_byte_tables(tuple(public_key))
+    return sum(table[byte] for table, byte in zip(tables, plaintext))
+
+# Function to encrypt many plaintexts for many public keys
+    # """
+    # Encrypt every plaintext for every public key, e.g. one session key for
+    # all recipients of a distribution list.
+    
+    # Args:
+    #     plaintexts (list): The byte strings to encrypt.
+    #     public_keys (list): The public keys.
+        
+    # Returns:
+    #     list: One row per plaintext with one ciphertext per public key.
+    # """
+def encrypt_many(plaintexts, public_keys):
+    all_tables = [cached_byte_tables(tuple(public_key)) for public_key in public_keys]
+    for plaintext in plaintexts:
+        if any(len(plaintext) != len(tables) for tables in all_tables):
+            raise ValueError("The length of plaintext must match the length of the public key.")
+    return [[sum(table[byte] for table, byte in zip(tables, plaintext)) for tables in all_tables]
+            for plaintext in plaintexts]
+
+
+# Private key holding everything decryption needs, computed once
+    # """
+    # A Merkle-Hellman private key with r^-1 mod q precomputed.
+    
+    # Args:
+    #     private_key (list): The private key, a super-increasing sequence.
+    #     q (int): The modulus used to generate the public key.
+    #     r (int): The multiplier used to generate the public key.
+    # """
+class PrivateKey:
+    def __init__(self, private_key, q, r):
+        self.sequence = list(private_key)
+        self.q = q
+        self.r = r
+        self.r_inverse = inverse(r, q)
+        n = len(self.sequence)
+        # (element, bit) from the largest element down; element i is bit
+        # n - 1 - i of the plaintext, as in int(decrypt(...), 2)
+        self.steps = [(self.sequence[i], 1 << (n - 1 - i)) for i in reversed(range(n))]
+
+    @instrument.timed('mh_decrypt')
+    def decrypt_int(self, ciphertext):
+        # """ Decrypt to an int, same as int(decrypt(ciphertext, ...), 2). """
+        remainder = ciphertext * self.r_inverse % self.q
+        value = 0
+        for element, bit in self.steps:
+            if remainder >= element:
+                remainder -= element
+                value |= bit
+        return value
+
+    def decrypt_bytes(self, ciphertext):
+        # """ Decrypt to len(private_key) // 8 bytes, e.g. a FEAL key. """
+        return self.decrypt_int(ciphertext).to_bytes(len(self.sequence) // 8, 'big')
+
+    def decrypt(self, ciphertext):
+        # """ Decrypt to a binary string, same as decrypt(ciphertext, ...). """
+        return format(self.decrypt_int(ciphertext), '0%db' % len(self.sequence))
+
+    def decrypt_many(self, ciphertexts):
+        # """ Decrypt a batch of wrapped keys to bytes. """
+        return [self.decrypt_bytes(ciphertext) for ciphertext in ciphertexts]
@@ -0,0 +1,149 @@
+""" Modular arithmetic shared by the signature and curve code: inversion,
+    batched inversion, simultaneous multi-exponentiation and fixed-base
+    exponentiation tables.
+"""
+
+import instrument
+
+# Sliding-window width used by multi_pow
+MULTI_POW_WINDOW = 4
+
+# Below this modulus size separate built-in pow() calls are faster than multi_pow
+MULTI_POW_MIN_BITS = 512
+
+# Digit width of FixedBasePow tables
+FIXED_BASE_WINDOW = 4
+
+def inverse(a, m):
+    """ Returns the inverse of a mod m, raising ValueError if there is none.
+
+        The built-in three-argument pow runs the extended Euclidean algorithm
+        iteratively in C, which is faster than any Python-level loop and has
+        no recursion limit.
+    """
+    if instrument.enabled:
+        instrument.count('mod.inverse')
+    if m == 1:
+        return 0
+    try:
+        return pow(a, -1, m)
+    except ValueError:
+        raise ValueError("Modular inverse does not exist.") from None
+
+def invert_many(values, m):
+    """ Returns the inverses of all values mod m with a single inversion
+        (Montgomery's simultaneous inversion): 3(n - 1) multiplications and
+        one inverse instead of n inverses.
+    """
+    values = list(values)
+    if not values:
+        return []
+    if instrument.enabled:
+        instrument.count('mod.batched_inverses', len(values))
+    prefix = [values[0] % m]
+    for value in values[1:]:
+        prefix.append(prefix[-1] * value % m)
+
+    inv = inverse(prefix[-1], m)
+    result = [0] * len(values)
+    for i in range(len(values) - 1, 0, -1):
+        result[i] = inv * prefix[i - 1] % m
+        inv = inv * values[i] % m
+    result[0] = inv
+    return result
+
+def odd_powers(base, modulus, window):
+    """ Returns [b, b^3, b^5, ..., b^(2^window - 1)] mod modulus. """
+    powers = [base % modulus]
+    square = powers[0] * powers[0] % modulus
+    for _ in range((1 << (window - 1)) - 1):
+        powers.append(powers[-1] * square % modulus)
+    return powers
+
+def sliding_windows(exponent, window):
+    """ Returns {bit position: odd digit} for the sliding-window form of exponent,
+        so that exponent == sum(digit << position).
+    """
+    digits = {}
+    i = exponent.bit_length() - 1
+    while i >= 0:
+        if not (exponent >> i) & 1:
+            i -= 1
+            continue
+        # Longest window of at most `window` bits ending in a set bit
+        low = max(i - window + 1, 0)
+        while not (exponent >> low) & 1:
+            low += 1
+        digits[low] = (exponent >> low) & ((1 << (i - low + 1)) - 1)
+        i = low - 1
+    return digits
+
+def multi_pow(pairs, modulus, window=MULTI_POW_WINDOW):
+    """ Returns the product of base^exponent mod modulus over (base, exponent)
+        pairs with one shared chain of squarings (Shamir's trick generalised
+        to sliding windows).
+    """
+    pairs = [(base, exponent) for base, exponent in pairs if exponent]
+    if not pairs:
+        return 1 % modulus
+    if instrument.enabled:
+        instrument.count('mod.pow', len(pairs))
+    if modulus.bit_length() < MULTI_POW_MIN_BITS:
+        result = 1
+        for base, exponent in pairs:
+            result = result * pow(base, exponent, modulus) % modulus
+        return result
+    return multi_pow_windows(pairs, modulus, window)
+
+def multi_pow_windows(pairs, modulus, window=MULTI_POW_WINDOW):
+    """ The shared sliding-window chain of multi_pow, whatever the size of
+        modulus. Every exponent must be positive.
+    """
+    tables = [odd_powers(base, modulus, window) for base, _ in pairs]
+    digits = [sliding_windows(exponent, window) for _, exponent in pairs]
+    result = 1
+    for i in reversed(range(max(exponent.bit_length() for _, exponent in pairs))):
+        result = result * result % modulus
+        for table, windows in zip(tables, digits):
+            digit = windows.get(i)
+            if digit:
+                result = result * table[digit >> 1] % modulus
+    return result
+
+class FixedBasePow:
+    """ Precomputed powers of one base: row i holds base^(j * 2^(window * i))
+        for every window-bit digit j, so base^e costs one multiplication per
+        digit of e and no squarings.
+    """
+
+    def __init__(self, base, modulus, exponent_bits, window=FIXED_BASE_WINDOW):
+        self.base = base
+        self.modulus = modulus
+        self.window = window
+        self.rows = []
+        row_base = base % modulus
+        for _ in range(-(-exponent_bits // window)):
+            row = [1]
+            for _ in range((1 << window) - 1):
+                row.append(row[-1] * row_base % modulus)
+            self.rows.append(row)
+            row_base = row[-1] * row_base % modulus
+        self.max_exponent = 1 << (len(self.rows) * window)
+
+    def pow(self, exponent):
+        """ Returns base^exponent mod modulus for 0 <= exponent < 2^exponent_bits. """
+        if instrument.enabled:
+            instrument.count('mod.pow')
+        if not 0 <= exponent < self.max_exponent:
+            return pow(self.base, exponent, self.modulus)
+        modulus, window = self.modulus, self.window
+        mask = (1 << window) - 1
+        result = 1
+        for row in self.rows:
+            if not exponent:
+                break
+            digit = exponent & mask
+            if digit:
+                result = result * row[digit] % modulus
+            exponent >>= window
+        return result % modulus
@@ -0,0 +1,111 @@
+import random
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import sha256
+from multiprocessing import resource_tracker
+import CFB
+import feal_4
+import feal_numpy
+
+# Every CFB entry point must match a plain segment-by-segment CFB over the
+# list-based FEAL-4 reference, byte for byte, including the shorter tail
+# segment.
+
+SEGMENT_SIZES = [8, 16, 24, 32, 40, 48, 56, 64]
+
+LENGTHS = [0, 1, 7, 8, 9, 13, 64, 100, 513, 1000]
+
+def reference_cfb(key, iv, data, segment_size, decrypting):
+    # I(0) = IV, O(j) = CIPH(I(j)), C(j) = P(j) XOR leading bytes of O(j),
+    # I(j+1) = last 8 bytes of I(j) || C(j)
+    subkey = feal_4.key_generation(key)
+    size = segment_size // 8
+    register = bytes(iv)
+    out = bytearray()
+    for start in range(0, len(data), size):
+        segment = data[start:start + size]
+        o = feal_4.encrypt_reference(register, subkey)
+        result = bytes(x ^ y for x, y in zip(segment, o))
+        out += result
+        register = (register + (segment if decrypting else result))[-8:]
+    return bytes(out)
+
+def random_chunks(data, rng):
+    start = 0
+    while start < len(data):
+        size = rng.choice([1, 2, 3, 7, 8, 9, 17, 64, 1000])
+        yield data[start:start + size]
+        start += size
+
+def stream(crypt_class, key, iv, data, segment_size, rng):
+    crypt = crypt_class(key, iv, segment_size)
+    return b''.join(crypt.update(chunk) for chunk in random_chunks(data, rng)) + crypt.finalize()
+
+def check_against_reference(seed):
+    rng = random.Random(seed)
+    for segment_size in SEGMENT_SIZES:
+        for length in LENGTHS:
+            key, iv = rng.randbytes(8), rng.randbytes(8)
+            plaintext = rng.randbytes(length)
+            ciphertext = reference_cfb(key, iv, plaintext, segment_size, False)
+            assert reference_cfb(key, iv, ciphertext, segment_size, True) == plaintext
+            assert CFB.cfb_encrypt(key, iv, plaintext, segment_size) == ciphertext
+            assert CFB.cfb_decrypt(key, iv, ciphertext, segment_size) == plaintext
+            assert CFB.cfb_encrypt_hash(key, iv, plaintext, segment_size) == (ciphertext, sha256(ciphertext).digest())
+            assert CFB.cfb_decrypt_hash(key, iv, ciphertext, segment_size) == (plaintext, sha256(ciphertext).digest())
+            assert stream(CFB.CfbEncryptor, key, iv, plaintext, segment_size, rng) == ciphertext
+            assert stream(CFB.CfbDecryptor, key, iv, ciphertext, segment_size, rng) == plaintext
+
+def check_chunk_boundaries(seed, monkeypatch):
+    # The _hash functions work in BUFFER_SIZE chunks of whole segments; a
+    # small BUFFER_SIZE that is not a multiple of every segment size puts
+    # several chunk boundaries in short messages
+    monkeypatch.setattr(CFB, 'BUFFER_SIZE', 100)
+    rng = random.Random(seed)
+    for segment_size in SEGMENT_SIZES:
+        for length in (99, 100, 101, 250, 1000):
+            key, iv = rng.randbytes(8), rng.randbytes(8)
+            plaintext = rng.randbytes(length)
+            ciphertext = reference_cfb(key, iv, plaintext, segment_size, False)
+            assert CFB.cfb_encrypt_hash(key, iv, plaintext, segment_size)[0] == ciphertext
+            assert CFB.cfb_decrypt_hash(key, iv, ciphertext, segment_size)[0] == plaintext
+
+def check_parallel(seed, monkeypatch):
+    # Force the process pool on small inputs; the ranges split mid-message,
+    # so every worker but the first starts from a register in the ciphertext
+    monkeypatch.setattr(CFB, 'PARALLEL_THRESHOLD', 0)
+    resource_tracker.ensure_running()  # Shared by the forked workers
+    rng = random.Random(seed)
+    with ProcessPoolExecutor(2) as executor:
+        for segment_size in SEGMENT_SIZES:
+            for length in (1, 13, 1000, 4096 + 3):
+                key, iv = rng.randbytes(8), rng.randbytes(8)
+                plaintext = rng.randbytes(length)
+                ciphertext = CFB.cfb_encrypt(key, iv, plaintext, segment_size)
+                for workers in (2, 3):
+                    assert CFB.cfb_decrypt_parallel(key, iv, ciphertext, segment_size,
+                                                    workers=workers, executor=executor) == plaintext
+                out = bytearray(ciphertext)
+                assert CFB.cfb_decrypt_parallel(key, iv, out, segment_size, out=out, workers=2,
+                                                executor=executor) is out
+                assert out == plaintext
+
+def test_match_reference():
+    check_against_reference(1)
+
+def test_pure_python_path_matches_reference(monkeypatch):
+    monkeypatch.setattr(feal_numpy, 'AVAILABLE', False)
+    check_against_reference(2)
+
+def test_chunk_boundaries(monkeypatch):
+    check_chunk_boundaries(3, monkeypatch)
+
+def test_chunk_boundaries_pure_python(monkeypatch):
+    monkeypatch.setattr(feal_numpy, 'AVAILABLE', False)
+    check_chunk_boundaries(4, monkeypatch)
+
+def test_parallel_decrypt_matches(monkeypatch):
+    check_parallel(5, monkeypatch)
+
+def test_parallel_decrypt_matches_pure_python(monkeypatch):
+    monkeypatch.setattr(feal_numpy, 'AVAILABLE', False)
+    check_parallel(6, monkeypatch)
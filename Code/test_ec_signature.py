@@ -0,0 +1,54 @@
+import random
+import ec_arith
+import ec_signature
+from hashlib import sha256
+from utils import curve
+
+# verify and verify_batch accept every signature made by sign and reject a
+# wrong message or a changed s. Batches of more than PIPPENGER_THRESHOLD
+# pairs go through the Pippenger sum.
+
+BATCH_SIZE = 40
+
+def make_batch(rng, size):
+    keys = [ec_signature.generate_keys() for _ in range(4)]
+    items = []
+    for i in range(size):
+        private_key, public_key = keys[i % len(keys)]
+        message = rng.randbytes(rng.randrange(1, 100))
+        items.append((message, ec_signature.sign(private_key, message), public_key))
+    return items
+
+def test_round_trip():
+    private_key, public_key = ec_signature.generate_keys()
+    message = b'attack at dawn'
+    signature = ec_signature.sign(private_key, message)
+    assert ec_signature.verify(public_key, message, signature)
+    digest = sha256(message).digest()
+    assert ec_signature.verify(public_key, digest, ec_signature.sign(private_key, digest, prehashed=True), prehashed=True)
+
+def test_rejects_wrong_message_key_or_s():
+    private_key, public_key = ec_signature.generate_keys()
+    R, s = ec_signature.sign(private_key, b'attack at dawn')
+    assert not ec_signature.verify(public_key, b'attack at dusk', (R, s))
+    assert not ec_signature.verify(public_key, b'attack at dawn', (R, (s + 1) % curve.n))
+    assert not ec_signature.verify(ec_signature.generate_keys()[1], b'attack at dawn', (R, s))
+    assert not ec_signature.verify(public_key, b'attack at dawn', (R, 0))
+
+def test_verify_batch_accepts_valid_batches():
+    rng = random.Random(1)
+    assert 2 * BATCH_SIZE > ec_arith.PIPPENGER_THRESHOLD
+    assert ec_signature.verify_batch(make_batch(rng, BATCH_SIZE))
+    assert ec_signature.verify_batch(make_batch(rng, 3))
+
+def test_verify_batch_rejects_one_bad_item():
+    rng = random.Random(2)
+    items = make_batch(rng, BATCH_SIZE)
+    for index in (0, 17, BATCH_SIZE - 1):
+        message, (R, s), public_key = items[index]
+        other_key = items[(index + 1) % BATCH_SIZE][2]  # Keys alternate, so this is another one
+        for bad in [(message + b'!', (R, s), public_key),
+                    (message, (R, (s + 1) % curve.n), public_key),
+                    (message, (R, s), other_key)]:
+            batch = items[:index] + [bad] + items[index + 1:]
+            assert not ec_signature.verify_batch(batch)
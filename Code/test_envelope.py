@@ -0,0 +1,64 @@
+import random
+import pytest
+import envelope
+from ec_elgamal import generate_keys
+from elgamal_params import generate_parameters
+from merkle_hellman_knapsack import generate_key_pair
+
+# Every field of an envelope is covered by its signature: tampering with any
+# of them makes open() raise ValueError instead of returning a message.
+
+MESSAGE = b'attack at dawn, ' * 10
+
+def make_keys():
+    recipient_key, recipient_pub = generate_key_pair(64, seed=1)
+    system = generate_parameters(128)
+    private_key, public_key = generate_keys(system)
+    return recipient_key, recipient_pub, (system, private_key), (system, public_key)
+
+KEYS = make_keys()
+
+def tampered(data, **fields):
+    return envelope.pack(envelope.unpack(data)._replace(**fields))
+
+def test_round_trip():
+    recipient_key, recipient_pub, sig_key, sender_pub = KEYS
+    for segment_size in (8, 16, 32, 64):
+        data = envelope.seal(MESSAGE, recipient_pub, sig_key, segment_size)
+        assert envelope.open(data, recipient_key, sender_pub) == MESSAGE
+
+def test_tampered_fields_are_rejected():
+    recipient_key, recipient_pub, sig_key, sender_pub = KEYS
+    data = envelope.seal(MESSAGE, recipient_pub, sig_key)
+    e = envelope.unpack(data)
+    iv = bytes([e.iv[0] ^ 1]) + e.iv[1:]
+    for bad in [tampered(data, iv=iv),
+                tampered(data, segment_size=8),
+                tampered(data, wrapped_key=e.wrapped_key + recipient_pub[0]),
+                tampered(data, ciphertext=bytes([e.ciphertext[0] ^ 1]) + e.ciphertext[1:]),
+                tampered(data, signature=(e.signature[0], e.signature[1] + 1)),
+                b'FMv2' + data[4:]]:
+        with pytest.raises(ValueError):
+            envelope.open(bad, recipient_key, sender_pub)
+
+def test_truncated_envelopes_are_rejected():
+    recipient_key, recipient_pub, sig_key, sender_pub = KEYS
+    data = envelope.seal(MESSAGE, recipient_pub, sig_key)
+    for length in range(len(data) - len(MESSAGE)):
+        with pytest.raises(ValueError):
+            envelope.open(data[:length], recipient_key, sender_pub)
+
+def test_open_many_returns_a_result_per_envelope():
+    recipient_key, recipient_pub, sig_key, sender_pub = KEYS
+    rng = random.Random(2)
+    messages = [rng.randbytes(rng.randrange(100)) for _ in range(8)]
+    envelopes = envelope.seal_many(messages, recipient_pub, sig_key)
+    envelopes[3] = tampered(envelopes[3], segment_size=8)
+    envelopes[5] = envelopes[5][:10]
+    results = envelope.open_many(envelopes, recipient_key, sender_pub)
+    assert len(results) == len(messages)
+    for index, (result, message) in enumerate(zip(results, messages)):
+        if index in (3, 5):
+            assert isinstance(result, ValueError)
+        else:
+            assert result == message
@@ -1,4 +1,6 @@
 import collections
+import instrument
+from modular import inverse
 
 EllipticCurve = collections.namedtuple('EllipticCurve', 'name p a b g n h')
 
@@ -62,6 +64,9 @@ def point_add(point1, point2):
         # point1 + 0 = point1
         return point1
 
+    if instrument.enabled:
+        instrument.count('ec.point_add')
+
     x1, y1 = point1
     x2, y2 = point2
 
@@ -71,10 +76,10 @@ def point_add(point1, point2):
 
     if x1 == x2:
         # This is the case point1 == point2.
-        m = (3 * x1 * x1 + curve.a) * pow(2 * y1, -1, curve.p)
+        m = (3 * x1 * x1 + curve.a) * inverse(2 * y1, curve.p)
     else:
         # This is the case point1 != point2.
-        m = (y1 - y2) * pow(x1 - x2, -1, curve.p)
+        m = (y1 - y2) * inverse(x1 - x2, curve.p)
 
     x3 = m * m - x1 - x2
     y3 = y1 + m * (x3 - x1)
@@ -196,3 +201,33 @@ def S0(X1,X2,k=0):
 		return (T << 2)|(T >> (bit_block - 2))
 	return rot2((X1 + X2 + k) % 256) % 256
 
+
+##### Precomputed tables for FEAL-N #####
+
+def _sbox_table(k):
+	'''	S-box table indexed by (X1 << 8) | X2, so S(X1,X2) == table[(X1 << 8) | X2]. '''
+	rot2 = [S0(T, 0) for T in range(256)]
+	return bytes(rot2[(X1 + X2 + k) & 0xff] for X1 in range(256) for X2 in range(256))
+
+S0_TABLE = _sbox_table(0)
+S1_TABLE = _sbox_table(1)
+
+def _f_table():
+	'''
+	f1 and f2 of F1 only depend on (a0 ⊕ a1, a2 ⊕ a3), so both are fused into one
+	table indexed by ((a0 ⊕ a1) << 8) | (a2 ⊕ a3) and holding (f1 << 8) | f2.
+	'''
+	table = []
+	for u in range(256):
+		for v in range(256):
+			f1 = S1_TABLE[(u << 8) | v]
+			table.append((f1 << 8) | S0_TABLE[(v << 8) | f1])
+	return tuple(table)
+
+F_TABLE = _f_table()
+
+def F1_word(x):
+	''' F1 on a 32-bit word (a0 in the top byte), same output as F1 on the packed bytes. '''
+	y = x ^ (x >> 8)
+	f12 = F_TABLE[((y >> 8) & 0xff00) | (y & 0xff)]
+	return (S0_TABLE[((x >> 16) & 0xff00) | (f12 >> 8)] << 24) | (f12 << 8) | S1_TABLE[((f12 & 0xff) << 8) | (x & 0xff)]